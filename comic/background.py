@@ -0,0 +1,56 @@
+"""
+Small pools of background threads for work that follows a save, like
+generating image variants or re-rendering feeds.
+
+Each pool is named by the setting that holds its number of worker threads
+and is started the first time it is needed. With no workers there is no pool,
+and schedule() leaves it to the caller to do without.
+"""
+import concurrent.futures
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(setting):
+    """
+    The pool sized by settings.<setting>, or None with no workers
+    """
+    workers = getattr(settings, setting, 0)
+    if workers <= 0:
+        return None
+    with _executors_lock:
+        executor = _executors.get(setting)
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix=setting.lower())
+            _executors[setting] = executor
+    return executor
+
+def _run(func, args):
+    close_old_connections()
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Background %s%r failed', func.__qualname__, args)
+    finally:
+        close_old_connections()
+
+def schedule(setting, func, *args):
+    """
+    Run func(*args) on the pool sized by settings.<setting> once the current
+    transaction commits. Returns False, without scheduling anything, if that
+    pool has no workers.
+    """
+    executor = get_executor(setting)
+    if executor is None:
+        return False
+    transaction.on_commit(lambda: executor.submit(_run, func, args))
+    return True
@@ -1,11 +1,13 @@
 import datetime
 
 import django.db.models
-import django.template
 from django import forms
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.conf import settings
 
 from . import models
+from . import template_cache
 
 """
 I think I need some sort of customized ModelChoiceField that uses AutocompleteWidget
@@ -16,11 +18,17 @@ I need the form to know the user, I need the view to check that the user is allo
 """
 
 class AutocompleteWidget(forms.TextInput):
+    """
+    A text input with a datalist of choices. If search_url is given, the
+    datalist starts out empty and is filled from the search endpoint as the
+    author types, instead of listing every choice up front.
+    """
     template_name = "comic/autocomplete_widget.html"
 
-    def __init__(self, choices, attrs=None):
+    def __init__(self, choices, attrs=None, search_url=None):
         super().__init__(attrs)
         self.choices = choices
+        self.search_url = search_url
 
     def get_context(self, name, value, attrs):
         list_name = attrs.get('list', None)
@@ -28,10 +36,11 @@ class AutocompleteWidget(forms.TextInput):
             attrs['list'] = f'list_{name}'
 
         choices = self.choices
-        choices = [(x.search_key(), x.search_string()) for x in choices]
+        choices = [models.SearchEntry.choice(x) for x in choices]
 
         context = super().get_context(name, value, attrs)
         context['widget']['datalist'] = choices# [x[0].search_string() for x in self.choices]
+        context['widget']['search_url'] = self.search_url
 
         context['widget']['id'] = attrs['list']
         return context
@@ -42,8 +51,8 @@ class AutocompleteWidget(forms.TextInput):
 
 class HistoryModelField(forms.Field):
     widget=AutocompleteWidget
-    def __init__(self, model, choices, **kwargs):
-        kwargs['widget'] = self.widget(choices = choices)
+    def __init__(self, model, choices, search_url=None, **kwargs):
+        kwargs['widget'] = self.widget(choices = choices, search_url = search_url)
         self.model = model
         super().__init__(**kwargs)
 
@@ -76,11 +85,16 @@ class MyForm(forms.ModelForm):
         return super().__init__(**kwargs)
 
     def add_history_field(self, name, user, model, instance, choices = None, **kwargs):
-        if choices is None:
-            choices = model.get_all_latest(user=user)
-        self.fields[name] = HistoryModelField(model=model, choices=choices, **kwargs)
+        search_url = None
+        if choices is None and settings.COMIC_AUTOCOMPLETE_REMOTE:
+            #The widget looks choices up as the author types
+            search_url = model.get_search_url(user)
+            choices = []
+        elif choices is None:
+            choices = model.search('', user)
+        self.fields[name] = HistoryModelField(model=model, choices=choices, search_url=search_url, **kwargs)
         if instance == 'auto':
-            instance = choices[-1]
+            instance = model.get_latest_queryset(user=user).last()
         if not instance is None:
             self.initial[name] = instance.search_key()
 
@@ -103,12 +117,17 @@ class MyForm(forms.ModelForm):
         return self.cleaned_data['owner']
 
     def save(self, commit=True):
-        if self.is_create:
+        if not self.is_create:
+            return super().save(commit)
+
+        with transaction.atomic():
+            #Hold the key until the new entity has been saved with it
+            models.KeyLock.acquire(self.Meta.model)
             self.instance.hk = self.Meta.model.get_next_hk()
             owner = self.get_owner()
             self.instance.owner_id = owner.id
 
-        instance = super().save(commit)
+            instance = super().save(commit)
 
         return instance
 
@@ -159,6 +178,7 @@ class PageEditForm(MyForm):
             'page_key': forms.HiddenInput,
             'title': forms.TextInput,
             'alt_text': forms.TextInput,
+            'publish_at': forms.DateTimeInput(format='%Y-%m-%dT%H:%M', attrs={'type': 'datetime-local'}),
         }
 #        fields = ['title', 'arc', 'image', 'alt_text']
 
@@ -191,7 +211,12 @@ class PageCreateForm(PageEditForm):
     def save(self, commit=True):
         owner = self.cleaned_data['owner']
 
-        instance = super().save(commit)
+        with transaction.atomic():
+            #The page key shown on the form may have been taken since
+            models.KeyLock.acquire(models.ComicPage)
+            self.instance.page_key = models.ComicPage.get_next_page_key()
+
+            instance = super().save(commit)
 
         if not commit: return instance
 
@@ -441,7 +466,7 @@ class ThemeEditForm(MyForm):
                     template_text = self.data[key]
                     if template_text is None or template_text == '':
                         continue
-                    test_data.render_theme(date, {key:django.template.Template(template_text)} )
+                    test_data.render_theme(date, {key:template_cache.get_template_for_text(template_text)} )
 
                 except Exception as e:
                     self.add_error(key, str(e))
@@ -0,0 +1,77 @@
+"""
+A request scoped identity map for historical lookups.
+
+Rendering a single page asks for the same alias, arc, template and theme as of
+the same date over and over. While a map is active (see
+middleware.IdentityMapMiddleware) the history lookups in models.py store what
+they fetch here, keyed by (model, key name, key value, date), and later
+lookups are answered from memory.
+
+Callers are free to modify what they get back (sanitize does), so the map
+hands out shallow copies and keeps its own copy of everything it stores.
+"""
+import contextvars
+import copy
+
+_current = contextvars.ContextVar('comic_identity_map', default = None)
+
+
+class IdentityMap():
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.copy(value)
+
+    def put(self, key, value):
+        self.entries[key] = copy.copy(value)
+
+    def clear(self):
+        self.entries = {}
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+def activate():
+    """
+    Install a fresh identity map for the current context.
+    Returns the map and a token to pass to deactivate.
+    """
+    result = IdentityMap()
+    token = _current.set(result)
+    return result, token
+
+def deactivate(token):
+    _current.reset(token)
+
+def current():
+    """
+    The active identity map, or None if there isn't one
+    """
+    return _current.get()
+
+def get(key):
+    identity_map = _current.get()
+    if identity_map is None:
+        return None
+    return identity_map.get(key)
+
+def put(key, value):
+    identity_map = _current.get()
+    if identity_map is not None:
+        identity_map.put(key, value)
+
+def clear():
+    identity_map = _current.get()
+    if identity_map is not None:
+        identity_map.clear()
@@ -0,0 +1,141 @@
+"""
+Resized and re-encoded derivatives of uploaded page images.
+
+Each variant named in settings.COMIC_IMAGE_VARIANTS is a maximum width, or
+None for the original's, and a Pillow format. Derivative files are stored
+under a path made from the sha256 of the original image's contents, so an
+image that is referenced by several page versions, or uploaded twice, is only
+processed once. ImageVariant rows map an original's storage name to its
+derivatives.
+
+Generation is kicked off after the transaction that saved a page commits and
+runs on a small pool of background threads, sized by
+settings.COMIC_IMAGE_VARIANT_WORKERS. With no workers, nothing runs in the
+web process and the generate_image_variants management command has to be
+run instead; it also fills in variants for images uploaded before this
+existed.
+"""
+import hashlib
+import io
+import logging
+
+from PIL import Image, ImageOps, features
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from . import background
+from . import models
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIANTS = {}
+
+MIME_TYPES = {
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+}
+
+#Formats already warned about, so a missing codec is logged once per process
+_unsupported = set()
+
+
+def get_variants():
+    """
+    {name: (width, format)} for the variants that this Pillow can write
+    """
+    result = {}
+    for name, spec in getattr(settings, 'COMIC_IMAGE_VARIANTS', DEFAULT_VARIANTS).items():
+        fmt = spec['format'].upper()
+        if fmt in ('WEBP', 'AVIF') and not features.check(fmt.lower()):
+            if fmt not in _unsupported:
+                _unsupported.add(fmt)
+                logger.warning('Skipping %s image variants: Pillow has no %s support', fmt, fmt.lower())
+            continue
+        result[name] = (spec['width'], fmt)
+    return result
+
+def get_digest(fp):
+    """
+    sha256 of an open file, read in chunks
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(64 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def get_path(digest, name, fmt):
+    return f'variants/{digest[:2]}/{digest}/{name}.{fmt.lower()}'
+
+def encode(image, width, fmt):
+    """
+    Scale image down to at most width wide, unless width is None, and
+    encode it as fmt. Returns (bytes, width, height).
+    """
+    result = image.copy()
+    if width is not None and result.width > width:
+        result.thumbnail((width, result.height), Image.LANCZOS)
+    if fmt == 'JPEG' and result.mode not in ('RGB', 'L'):
+        result = result.convert('RGB')
+    elif result.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        result = result.convert('RGBA')
+
+    buffer = io.BytesIO()
+    result.save(buffer, fmt, quality=getattr(settings, 'COMIC_IMAGE_VARIANT_QUALITY', 80))
+    return buffer.getvalue(), result.width, result.height
+
+def generate(source):
+    """
+    Make sure every configured variant of the image stored as source exists,
+    creating the derivative files and ImageVariant rows that are missing.
+    Returns the number of files that had to be encoded.
+    """
+    variants = get_variants()
+    existing = set(models.ImageVariant.objects.filter(source=source).values_list('name', flat=True))
+    missing = {k: v for k, v in variants.items() if k not in existing}
+    if len(missing) == 0:
+        return 0
+
+    with models.ComicPage.image.field.storage.open(source, 'rb') as fp:
+        digest = get_digest(fp)
+        fp.seek(0)
+        image = None
+        encoded = 0
+        for name, (width, fmt) in missing.items():
+            path = get_path(digest, name, fmt)
+            if default_storage.exists(path):
+                #Another upload had the same contents
+                with default_storage.open(path, 'rb') as done:
+                    with Image.open(done) as derivative:
+                        out_width, out_height = derivative.size
+                size = default_storage.size(path)
+            else:
+                if image is None:
+                    image = ImageOps.exif_transpose(Image.open(fp))
+                data, out_width, out_height = encode(image, width, fmt)
+                path = default_storage.save(path, ContentFile(data))
+                size = len(data)
+                encoded += 1
+
+            models.ImageVariant.objects.update_or_create(
+                    source = source, name = name,
+                    defaults = {
+                        'digest': digest,
+                        'file': path,
+                        'width': out_width,
+                        'height': out_height,
+                        'size': size,
+                        'mime_type': MIME_TYPES.get(fmt, f'image/{fmt.lower()}'),
+                    })
+    return encoded
+
+def schedule(source):
+    """
+    Generate the variants of source in the background once the current
+    transaction commits
+    """
+    if len(get_variants()) > 0:
+        background.schedule('COMIC_IMAGE_VARIANT_WORKERS', generate, source)
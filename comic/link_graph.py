@@ -0,0 +1,193 @@
+"""
+An in-memory index of the reading order graph formed by the live ComicLinks.
+
+Pages are identified by their page key, which doesn't change between page
+versions, so the graph only changes when links are created or deleted, when
+a page moves to another arc or changes owner, or when a scheduled page is
+released. The graph holds the pages released so far and the live links
+between them, and answers reachability, reading order and orphan questions
+without any further queries.
+
+Each process keeps its own copy. Every change bumps a Generation row in the
+database once it commits. A process applies its own link saves to its graph
+incrementally (see models.link_graph_post_save), and rebuilds it, in two
+queries, when the generation or the latest release time has moved on in a
+way it didn't see. Checking that costs two small queries per get_graph().
+"""
+import collections
+import threading
+
+import django.utils.timezone
+from django.db import transaction
+from django.db.models import Max
+
+from . import models
+
+GENERATION = 'link_graph'
+
+Edge = collections.namedtuple('Edge', ['to_key', 'kind', 'owner_hk', 'created_at'])
+Node = collections.namedtuple('Node', ['arc_hk', 'owner_hk'])
+
+
+class LinkGraph():
+
+    def __init__(self, pages, links):
+        """
+        pages is an iterable of (page_key, arc hk, owner hk) for current pages
+        links is an iterable of (link id, from key, to key, kind, owner hk, created_at)
+        """
+        self.nodes = {key: Node(arc_hk, owner_hk) for key, arc_hk, owner_hk in pages}
+        self.edges = collections.defaultdict(dict)
+        for link_id, from_key, *edge in links:
+            self.edges[from_key][link_id] = Edge(*edge)
+
+    @classmethod
+    def build(cls):
+        """
+        The graph of the pages released so far, and the live links between them
+        """
+        now = django.utils.timezone.now()
+        pages = list(models.ComicPage.get_latest_queryset(date=now).values_list(
+                    'page_key', 'arc__hk', 'owner__hk'))
+        released = {x[0] for x in pages}
+        links = models.ComicLink.objects.filter(deleted_at__isnull=True).values_list(
+                    'id', 'from_page__page_key', 'to_page__page_key', 'kind', 'owner__hk', 'created_at')
+        links = [x for x in links if x[1] in released and x[2] in released]
+        return cls(pages, links)
+
+    def add_link(self, link):
+        #Links to or from pages that aren't released yet stay out
+        if link.from_key in self.nodes and link.to_key in self.nodes:
+            self.edges[link.from_key][link.id] = Edge(
+                    link.to_key, link.kind, link.owner.hk, link.created_at)
+
+    def remove_link(self, link):
+        self.edges[link.from_key].pop(link.id, None)
+
+    def links_from(self, page_key, kinds='npf'):
+        return [x for x in self.edges.get(page_key, {}).values() if x.kind in kinds]
+
+    def reachable(self, page_key, kinds='npf'):
+        """
+        The set of page keys that can be reached from page_key by following
+        links of the given kinds, including page_key itself.
+        """
+        result = {page_key}
+        pending = [page_key]
+        while len(pending) > 0:
+            for edge in self.links_from(pending.pop(), kinds):
+                if edge.to_key not in result:
+                    result.add(edge.to_key)
+                    pending.append(edge.to_key)
+        return result
+
+    def next_page(self, page_key):
+        """
+        The canonical next page: the page owner's own next links come first,
+        oldest first, the same order the reader page shows them in.
+        """
+        node = self.nodes.get(page_key)
+        owner_hk = node.owner_hk if node is not None else None
+        edges = sorted(self.links_from(page_key, 'n'),
+                    key = lambda x: [x.owner_hk != owner_hk, x.created_at])
+        if len(edges) == 0:
+            return None
+        return edges[0].to_key
+
+    def arc_pages(self, arc_hk):
+        return sorted(k for k,v in self.nodes.items() if v.arc_hk == arc_hk)
+
+    def reading_path(self, arc_hk):
+        """
+        The page keys of an arc in reading order, following canonical next
+        links from the arc's first page for as long as they stay in the arc.
+        The first page is the lowest keyed page with no next link into it
+        from elsewhere in the arc.
+        """
+        pages = self.arc_pages(arc_hk)
+        if len(pages) == 0:
+            return []
+
+        targets = set()
+        for key in pages:
+            targets |= {x.to_key for x in self.links_from(key, 'n')}
+        starts = [x for x in pages if x not in targets]
+        current = starts[0] if len(starts) > 0 else pages[0]
+
+        result = []
+        while current is not None and current not in result:
+            if current not in self.nodes or self.nodes[current].arc_hk != arc_hk:
+                break
+            result.append(current)
+            current = self.next_page(current)
+        return result
+
+    def orphans(self, root=None):
+        """
+        Current pages that can't be reached by following links from root,
+        which defaults to the first page.
+        """
+        if len(self.nodes) == 0:
+            return []
+        if root is None:
+            root = min(self.nodes.keys())
+        return sorted(self.nodes.keys() - self.reachable(root))
+
+
+
+_lock = threading.Lock()
+_graph = None
+_state = None
+
+def get_state():
+    """
+    The generation and latest release time that a graph is current for
+    """
+    released = models.ComicPage.objects.filter(released_at__lte=django.utils.timezone.now())
+    return (models.Generation.get(GENERATION), released.aggregate(x=Max('released_at'))['x'])
+
+def get_graph():
+    """
+    The current graph for this process, rebuilt if anything changed that
+    this process didn't apply itself
+    """
+    global _graph, _state
+    state = get_state()
+    with _lock:
+        if _graph is None or state != _state:
+            _graph = LinkGraph.build()
+            _state = state
+        return _graph
+
+def _apply(link):
+    global _graph, _state
+    generation = models.Generation.bump(GENERATION)
+    with _lock:
+        if _graph is None or _state[0] is None or generation != _state[0] + 1:
+            _graph = None
+            return
+        if link.deleted_at is None:
+            _graph.add_link(link)
+        else:
+            _graph.remove_link(link)
+        _state = (generation, _state[1])
+
+def _drop():
+    global _graph
+    models.Generation.bump(GENERATION)
+    with _lock:
+        _graph = None
+
+def link_changed(link):
+    """
+    Apply a created or deleted link to this process's graph, and tell the
+    others, once the current transaction commits
+    """
+    transaction.on_commit(lambda: _apply(link))
+
+def invalidate():
+    """
+    Drop every process's graph once the current transaction commits, for
+    changes that aren't a single link
+    """
+    transaction.on_commit(_drop)
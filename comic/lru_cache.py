@@ -0,0 +1,78 @@
+"""
+A bounded, thread safe LRU cache of computed values.
+
+Values are computed on a miss by compute(*args), which returns the value and
+its size, and the least recently used entries are evicted once there are more
+than max_entries of them or their sizes add up to more than max_size. A value
+bigger than max_size on its own is returned without being stored. The lock
+isn't held while computing, so two threads missing on the same key at once
+both compute it and the first to finish is kept.
+
+template_cache and markdown_cache are built on this.
+"""
+import collections
+import threading
+
+
+class LRUCache():
+
+    def __init__(self, max_entries, max_size, compute=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        if compute is not None:
+            self.compute = compute
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def compute(self, *args):
+        """
+        Return (value, size) for args; subclasses that aren't given a
+        compute function override this
+        """
+        raise NotImplementedError()
+
+    def get(self, key, *args):
+        """
+        Return the value cached under key, computing it from args only if
+        there is nothing cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        value, size = self.compute(*args)
+        if size > self.max_size:
+            return value
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_size:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,32 @@
+import mimetypes
+
+from django.core.files.images import get_image_dimensions
+from django.core.management.base import BaseCommand
+
+from comic import models
+
+
+class Command(BaseCommand):
+    help = 'Record the size, mime type and dimensions of page images uploaded before they were stored on the page'
+
+    def handle(self, *args, **options):
+        storage = models.ComicPage.image.field.storage
+        missing = models.ComicPage.objects.exclude(image='').filter(image_size__isnull=True)
+        names = missing.values_list('image', flat=True).distinct().order_by('image')
+
+        total = 0
+        for name in names:
+            if not storage.exists(name):
+                self.stderr.write(f'{name}: missing, skipped')
+                continue
+            with storage.open(name, 'rb') as fp:
+                width, height = get_image_dimensions(fp)
+            #Every version that uses this image gets the same description
+            count = missing.filter(image=name).update(
+                    image_size = storage.size(name),
+                    image_mime_type = mimetypes.guess_type(name)[0],
+                    image_width = width,
+                    image_height = height)
+            self.stdout.write(f'{name}: {count} page versions')
+            total += count
+        self.stdout.write(f'{total} page versions updated')
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from comic import models
+
+
+class Command(BaseCommand):
+    help = ('Fill in the page keys of links saved before links were addressed '
+            'by page key. Run this before enabling COMIC_LINKS_BY_PAGE_KEY.')
+
+    def handle(self, *args, **options):
+        count = models.ComicLink.backfill_keys()
+        self.stdout.write(f'Updated {count} link keys')
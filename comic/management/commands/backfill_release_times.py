@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+
+from comic import models
+
+
+class Command(BaseCommand):
+    help = 'Set the release time of page versions saved before scheduled publishing existed to their creation time'
+
+    def handle(self, *args, **options):
+        created_at = models.OwnedHistory.objects.filter(pk=OuterRef('pk')).values('created_at')[:1]
+        count = models.ComicPage.objects.filter(released_at__isnull=True).update(released_at=Subquery(created_at))
+        self.stdout.write(f'{count} page versions updated')
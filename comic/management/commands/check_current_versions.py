@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from comic import models
+
+
+class Command(BaseCommand):
+    help = 'Check that the current version pointer table agrees with the history'
+
+    def handle(self, *args, **options):
+        problems = 0
+        for model in models.CurrentVersion.history_models():
+            bad = models.CurrentVersion.find_inconsistencies(model)
+            for key, actual, expected in bad:
+                self.stdout.write(f'{model._meta.label} {key}: points at {actual}, expected {expected}')
+            problems += len(bad)
+
+        if problems > 0:
+            raise CommandError(f'{problems} inconsistent pointers, run rebuild_current_versions')
+        self.stdout.write('Current version pointers are consistent')
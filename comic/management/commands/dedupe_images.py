@@ -0,0 +1,79 @@
+import os
+import re
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from comic import models
+
+
+class Command(BaseCommand):
+    help = ('Move page images into content addressed storage, pointing every page version at '
+            'the deduplicated file, then delete image files that no page refers to. Files moved '
+            'are left in place until the next run, for pages already rendered with them')
+
+    hashed_name = re.compile(r'(^|/)([0-9a-f]{2})/\2[0-9a-f]{62}(\.[^/]*)?$')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+            help='Report what would be moved and deleted without changing anything')
+        parser.add_argument('--min-age', type=int, default=3600,
+            help='Only delete unreferenced files older than this many seconds, so uploads '
+                 'whose page has not been saved yet are kept (default 3600)')
+
+    def handle(self, *args, **options):
+        storage = models.ComicPage.image.field.storage
+        dry_run = options['dry_run']
+
+        names = models.ComicPage.objects.exclude(image='').values_list('image', flat=True).distinct()
+        moves = {}
+        for name in names.order_by('image'):
+            if self.hashed_name.search(name):
+                continue
+            if not storage.exists(name):
+                self.stderr.write(f'{name}: missing, skipped')
+                continue
+
+            if dry_run:
+                target = storage.get_hashed_name(name, storage.hash_file(name))
+            else:
+                with storage.open(name, 'rb') as fp:
+                    target = storage.save(name, fp)
+                self.repoint(name, target)
+            self.stdout.write(f'{name} -> {target}')
+            moves[name] = target
+
+        #The files just moved stay until a later run: renders cached before
+        #the move still show them, and moving doesn't change what's modified
+        referenced = set(models.ComicPage.objects.values_list('image', flat=True))
+        referenced |= moves.keys() | set(moves.values())
+        cutoff = time.time() - options['min_age']
+        root = storage.path(models.ComicPage.image.field.upload_to)
+        deleted = 0
+        freed = 0
+        for directory, _, files in os.walk(root):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, storage.location).replace(os.sep, '/')
+                if name in referenced or os.path.getmtime(path) > cutoff:
+                    continue
+                freed += os.path.getsize(path)
+                if not dry_run:
+                    storage.delete(name)
+                self.stdout.write(f'{name}: deleted')
+                deleted += 1
+        self.stdout.write(f'{len(moves)} images moved, {deleted} files deleted, {freed} bytes freed')
+
+    @transaction.atomic
+    def repoint(self, name, target):
+        """
+        Point the page versions and image variants for name at target. This
+        is an UPDATE rather than a save, since the page contents are unchanged.
+        """
+        models.ComicPage.objects.filter(image=name).update(image=target)
+
+        variants = models.ImageVariant.objects.filter(source=name)
+        existing = models.ImageVariant.objects.filter(source=target).values('name')
+        variants.filter(name__in=existing).delete()
+        variants.update(source=target)
@@ -0,0 +1,103 @@
+import datetime
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from comic import models
+
+
+class Command(BaseCommand):
+    help = ('Print the database query plans and timings for the hot history, link and '
+            'forum queries. Run it against a seeded database before and after '
+            'migrating to compare them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, metavar='N',
+            help='First fill an empty database with N pages of three versions each, '
+                 'linked in a chain and with a forum post each')
+        parser.add_argument('--repeat', type=int, default=20,
+            help='Times each query is run for its timing (default 20)')
+
+    def seed(self, count):
+        if models.ComicPage.objects.exists():
+            raise CommandError('--seed needs a database without any pages')
+
+        user, _ = get_user_model().objects.get_or_create(username='explain_queries_seed')
+        author = models.Author.objects.create(user=user)
+        alias = models.Alias(owner=author, display_name='Seed')
+        alias.save()
+        template = models.PageTemplate(owner=alias, name='Seed', template='')
+        template.save()
+        theme = models.PageTheme(owner=alias, name='Seed')
+        theme.save()
+        arc = models.ComicArc(owner=alias, slug_name='seed', display_name='Seed')
+        arc.save()
+
+        previous = None
+        for i in range(count):
+            page = models.ComicPage(owner=alias, page_key=models.ComicPage.fmt_page_key(i),
+                        title=f'Seed {i}', arc=arc, template=template, theme=theme)
+            for version in range(3):
+                page.alt_text = f'Version {version}'
+                page.save()
+            if previous is not None:
+                models.ComicLink(kind='n', from_page=previous, to_page=page, owner=alias).save()
+                models.ComicLink(kind='p', from_page=page, to_page=previous, owner=alias).save()
+            models.ForumPost(text=f'seed {i}', source=page).save()
+            previous = page
+
+    def queries(self):
+        date = datetime.datetime.now(datetime.timezone.utc)
+        page = models.ComicPage.objects.order_by('-created_at').first()
+        page_key = page.page_key if page is not None else '0000'
+        page_id = page.id if page is not None else 0
+
+        yield 'Latest version by hk', models.Alias.objects.filter(
+                hk=1, created_at__lte=date).order_by('-created_at')[:1]
+        #The reader path, ComicPage.get_view_page
+        yield 'Latest released version by page_key', models.ComicPage.objects.filter(
+                page_key=page_key, released_at__lte=date).order_by('-released_at')[:1]
+        yield 'Latest versions of every page', models.ComicPage.get_latest_queryset(date=date)
+        yield 'Live links from a page', models.ComicLink.objects.filter(
+                from_page_id=page_id, kind='n').exclude(
+                deleted_at__lte=date).exclude(created_at__gt=date)
+        yield 'Forum posts for a page', models.ForumPost.objects.filter(
+                source__page_key=page_key, timestamp__lte=date).order_by('-timestamp')[:1]
+
+        #The parts of ComicPage.get_last_modified
+        yield 'Last history change', models.OwnedHistory.objects.filter(
+                created_at__lte=date).order_by('-created_at').values('created_at')[:1]
+        yield 'Last page release', models.ComicPage.objects.filter(
+                released_at__lte=date).order_by('-released_at').values('released_at')[:1]
+        yield 'Last link creation', models.ComicLink.objects.filter(
+                created_at__lte=date).order_by('-created_at').values('created_at')[:1]
+        yield 'Last link deletion', models.ComicLink.objects.filter(
+                deleted_at__lte=date).order_by('-deleted_at').values('deleted_at')[:1]
+        yield 'Last forum post', models.ForumPost.objects.filter(
+                timestamp__lte=date).order_by('-timestamp').values('timestamp')[:1]
+
+    def time(self, queryset, repeat):
+        """
+        Median time in milliseconds to fetch every row of queryset
+        """
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(queryset.all())
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            with transaction.atomic():
+                self.seed(options['seed'])
+            self.stdout.write(f'Seeded {options["seed"]} pages')
+
+        for name, queryset in self.queries():
+            self.stdout.write(f'== {name}')
+            self.stdout.write(queryset.explain())
+            self.stdout.write(f'{self.time(queryset, options["repeat"]):.3f} ms')
+            self.stdout.write('')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from comic import static_feeds
+
+
+class Command(BaseCommand):
+    help = 'Render every RSS and Atom feed into its static file'
+
+    def handle(self, *args, **options):
+        if static_feeds.get_base_url() is None:
+            raise CommandError('Set COMIC_FEED_BASE_URL so feeds can be rendered outside a request')
+        count = static_feeds.regenerate()
+        self.stdout.write(f'{count} feeds written to {static_feeds.get_root()}')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from comic import models
+from comic import image_variants
+
+
+class Command(BaseCommand):
+    help = 'Generate any missing image variants for every uploaded page image'
+
+    def handle(self, *args, **options):
+        sources = models.ComicPage.objects.exclude(image='').values_list('image', flat=True).distinct()
+        total = 0
+        for source in sources.order_by('image'):
+            encoded = image_variants.generate(source)
+            if encoded > 0:
+                self.stdout.write(f'{source}: {encoded} encoded')
+            total += encoded
+        self.stdout.write(f'{total} variants encoded')
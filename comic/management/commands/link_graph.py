@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from comic import link_graph
+from comic import models
+
+
+class Command(BaseCommand):
+    help = 'Query the reading order graph formed by the comic links'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reachable', metavar='PAGE_KEY',
+                help='List the pages reachable from PAGE_KEY')
+        parser.add_argument('--path', metavar='ARC_HK', type=int,
+                help='Show the canonical reading path through an arc')
+        parser.add_argument('--orphans', action='store_true',
+                help='List the pages that can\'t be reached from the first page')
+
+    def handle(self, *args, **options):
+        graph = link_graph.get_graph()
+
+        if options['reachable'] is not None:
+            try:
+                page_key = models.ComicPage.clean_page_key(options['reachable'])
+            except ValueError:
+                raise CommandError(f'Malformed page key {options["reachable"]}')
+            result = sorted(graph.reachable(page_key))
+        elif options['path'] is not None:
+            result = graph.reading_path(options['path'])
+        elif options['orphans']:
+            result = graph.orphans()
+        else:
+            raise CommandError('Specify one of --reachable, --path or --orphans')
+
+        self.stdout.write(' '.join(result))
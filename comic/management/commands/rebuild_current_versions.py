@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from comic import models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the current version pointer table from the existing history'
+
+    def handle(self, *args, **options):
+        for model in models.CurrentVersion.history_models():
+            count = models.CurrentVersion.rebuild(model)
+            self.stdout.write(f'{model._meta.label}: {count} pointers')
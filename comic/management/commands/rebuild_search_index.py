@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from comic import models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search index table from the current versions of searchable entities'
+
+    def handle(self, *args, **options):
+        for model in models.SearchEntry.searchable_models():
+            count = models.SearchEntry.rebuild(model)
+            self.stdout.write(f'{model._meta.label}: {count} entities')
@@ -0,0 +1,42 @@
+import time
+
+import django.utils.timezone
+from django.core.management.base import BaseCommand
+
+from comic import releases
+
+
+class Command(BaseCommand):
+    help = ('Wait for scheduled page releases, and at each one regenerate the feeds and render '
+            'the pages it changes so they are already cached when readers arrive')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+            help='Handle releases due since the last run, then exit, for running from cron')
+        parser.add_argument('--poll', type=int, default=60,
+            help='Longest time in seconds to sleep before checking for newly scheduled pages (default 60)')
+
+    def handle(self, *args, **options):
+        checked = releases.get_checked()
+        if checked is None:
+            checked = django.utils.timezone.now()
+            if options['once']:
+                releases.set_checked(checked)
+                return
+
+        while True:
+            now = django.utils.timezone.now()
+            count = releases.release(releases.get_due(checked, now))
+            if count > 0:
+                self.stdout.write(f'{now.isoformat()}: {count} pages rendered')
+            checked = now
+            releases.set_checked(checked)
+
+            if options['once']:
+                return
+
+            wait = options['poll']
+            upcoming = releases.get_next(checked)
+            if upcoming is not None:
+                wait = min(wait, (upcoming - django.utils.timezone.now()).total_seconds())
+            time.sleep(max(wait, 0))
@@ -0,0 +1,75 @@
+"""
+Shared Markdown rendering for transcripts and help pages.
+
+Building a markdown.Markdown instance loads and registers all of its
+extensions, which costs far more than converting a short transcript, so
+instances are kept in a pool and reset between uses instead. The converted
+HTML is also kept in a bounded LRU cache keyed by a hash of the source text,
+so text that is rendered again (the same transcript on every view of a page,
+or a help page) is a dictionary lookup.
+
+The limits come from settings.COMIC_MARKDOWN_CACHE_ENTRIES (number of
+converted texts) and settings.COMIC_MARKDOWN_CACHE_SIZE (total characters of
+converted HTML).
+"""
+import hashlib
+import queue
+
+import markdown
+
+from django.conf import settings
+
+from .lru_cache import LRUCache
+
+EXTENSIONS = ['extra', 'sane_lists', 'nl2br']
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_SIZE = 8 * 1024 * 1024
+
+
+class MarkdownCache(LRUCache):
+
+    def __init__(self, max_entries, max_size):
+        super().__init__(max_entries, max_size)
+        #Idle renderers; a converting thread takes one out so they are never shared
+        self.pool = queue.SimpleQueue()
+
+    def render(self, text):
+        """
+        Convert text with a pooled renderer
+        """
+        try:
+            md = self.pool.get_nowait()
+        except queue.Empty:
+            md = markdown.Markdown(extensions=EXTENSIONS)
+        try:
+            return md.reset().convert(text)
+        finally:
+            self.pool.put(md)
+
+    def compute(self, text):
+        html = self.render(text)
+        return html, len(html)
+
+    def convert(self, text):
+        """
+        Return the HTML for text, converting it only if it isn't cached.
+        """
+        return self.get(hashlib.sha256(text.encode()).digest(), text)
+
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = MarkdownCache(
+            getattr(settings, 'COMIC_MARKDOWN_CACHE_ENTRIES', DEFAULT_MAX_ENTRIES),
+            getattr(settings, 'COMIC_MARKDOWN_CACHE_SIZE', DEFAULT_MAX_SIZE))
+    return _cache
+
+def convert(text):
+    return get_cache().convert(text)
+
+def stats():
+    return get_cache().stats()
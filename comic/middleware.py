@@ -0,0 +1,26 @@
+from django.conf import settings
+
+from . import identity_map
+
+
+class IdentityMapMiddleware:
+    """
+    Gives each request its own identity map for historical lookups.
+    The map is available as request.identity_map, and when DEBUG is on its
+    hit/miss counters are reported in the X-Identity-Map response header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.identity_map, token = identity_map.activate()
+        try:
+            response = self.get_response(request)
+        finally:
+            identity_map.deactivate(token)
+
+        if settings.DEBUG:
+            stats = request.identity_map.stats()
+            response['X-Identity-Map'] = ', '.join(f'{k}={v}' for k,v in stats.items())
+        return response
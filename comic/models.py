@@ -1,17 +1,32 @@
 
 import datetime
+import logging
+import mimetypes
 
-from django.db import models
+from django.db import models, connection, transaction
 from django.db.models import signals as model_signals
+from django.db.models import OuterRef, Subquery, Max, Q, F, Value
+from django.db.models.functions import Concat
 from django.conf import settings
+from django.apps import apps
 
 from django.contrib.auth.models import User
 
-from django.template import Template, Context
+from django.template import Context
 
 from django.urls import reverse
 
 import django.utils
+import django.utils.timezone
+
+from . import identity_map
+from . import template_cache
+from . import link_graph
+from . import image_variants
+from . import static_feeds
+from .storage import get_image_storage
+
+logger = logging.getLogger(__name__)
 
 # Create your models here.
 
@@ -27,8 +42,6 @@ It might be nice to have a memory of the user's last-used templates, arcs, etc t
 
 It's possible I should like make the Alias model have a user property that returns its owner's user in order to make ownership checking more consistent and less error-prone
 
-It would be nice to be able to set a future creation date for a page so that it gets released at a scheduled datetime.
-
 """
 
 
@@ -55,8 +68,19 @@ class OwnedHistory(models.Model):
 
     default_hk = 'hk'
 
+    #The field ordering versions by when readers can first see them, for
+    #lookups as of a date. Subclasses whose versions can be scheduled for
+    #later override it with their own release time.
+    release_field = 'created_at'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['hk', 'created_at'], name='history_hk_created'),
+            models.Index(fields=['created_at'], name='history_created'),
+        ]
+
     def save(self, *args, **kwargs):
-        print(f'A history was saved: {self} {kwargs=}')
+        logger.debug('A history was saved: %s %s', self, kwargs)
         stamp = datetime.datetime.utcnow()
         force_update = kwargs.get('force_update', False)
         if not force_update and self.pk is not None:
@@ -71,11 +95,27 @@ class OwnedHistory(models.Model):
 
 
     def as_of(self, date=None):
-        result = self.__class__.objects.filter(hk = self.hk).order_by('-created_at')
+        cache_key = (self.__class__, 'hk', self.hk, date)
+        cached = identity_map.get(cache_key)
+        if cached is not None:
+            return cached
+
+        result = None
+        if date is None:
+            result = self.__class__.get_current(self.get_hk_value())
+
+        if result is None:
+            result = self.__class__.objects.filter(hk = self.hk)
+            if date is not None:
+                release_field = self.release_field
+                result = result.filter(**{f'{release_field}__lte': date}).order_by(
+                            f'-{release_field}', '-created_at', '-pk')
+            else:
+                result = result.order_by('-created_at')
+            result = result[0]
 
-        if date is not None:
-            result =  result.filter(created_at__lte=date)
-        return result[0]
+        identity_map.put(cache_key, result)
+        return result
 
     def is_owned_by(self, user):
         return self.owner.owner.user == user
@@ -83,11 +123,14 @@ class OwnedHistory(models.Model):
     def get_hk_value(self):
         return getattr(self,self.default_hk)
 
-    def sanitize(self, date):
+    def sanitize(self, date, author=None):
         """
         Replaces anything that shouldn't get sent to a user template
+        author, if provided, is the already sanitized owner
         """
-        self.author = self.owner.sanitize(date)
+        if author is None:
+            author = self.owner.sanitize(date)
+        self.author = author
         self.owner = None
         return self
 
@@ -95,52 +138,149 @@ class OwnedHistory(models.Model):
     def filter_owner(queryset, user):
         return queryset.filter(owner__owner__user=user)
 
+    @classmethod
+    def get_current(cls, hk):
+        """
+        Look up the current version of hk through the CurrentVersion pointer
+        table. Returns None if pointer lookups are disabled by the
+        COMIC_CURRENT_VERSIONS setting or if there is no pointer for hk.
+        """
+        if not getattr(settings, 'COMIC_CURRENT_VERSIONS', False):
+            return None
+        return cls.objects.filter(
+                current_for__model_label=cls._meta.label_lower,
+                current_for__key=str(hk)).first()
+
     @classmethod
     def get_latest(cls, hk, key=None):
         if key is None:
             key = cls.default_hk
-        result = cls.objects.filter(**{key: hk})
-        result = result.order_by('-created_at')
-        try:
-            return result[0]
-        except IndexError:
-            raise cls.DoesNotExist()
+
+        cache_key = (cls, key, str(hk), None)
+        cached = identity_map.get(cache_key)
+        if cached is not None:
+            return cached
+
+        result = None
+        if key == cls.default_hk:
+            result = cls.get_current(hk)
+
+        if result is None:
+            result = cls.objects.filter(**{key: hk})
+            result = result.order_by('-created_at')
+            try:
+                result = result[0]
+            except IndexError:
+                raise cls.DoesNotExist()
+
+        identity_map.put(cache_key, result)
+        return result
 
     @classmethod
-    def get_all_latest(cls, user=None, key=None, date=None):
+    def get_latest_queryset(cls, user=None, key=None, date=None):
         """
+        Returns a queryset containing only the most recent version of each
+        historical key, with the deduplication done by the database.
+
         user, if provided, filters results that are owned by user
         key, if specified, is the hk to use. Defaults to cls.default_hk
+        date, if provided, selects the most recent version released as of
+        that date; otherwise the newest version is selected, released or not
         """
         if key is None:
             key = cls.default_hk
-        result = cls.objects
+        result = cls.objects.all()
         if user is not None:
             result = cls.filter_owner(result, user)
+        order_field = 'created_at'
         if date is not None:
-            result = result.filter(created_at__lte=date)
-        result = result.order_by(f'-{key}', '-created_at')
-    
-        res_map = {}
-        for entry in result:
-            keyval = getattr(entry,key)
-            if not keyval in res_map.keys():
-                res_map[keyval] = entry
+            order_field = cls.release_field
+            result = result.filter(**{f'{order_field}__lte': date})
 
-        return list(res_map.values())
+        if connection.features.can_distinct_on_fields:
+            #DISTINCT ON (key) picks the newest row per key in one pass
+            latest = result.order_by(key, f'-{order_field}', '-pk').distinct(key)
+            result = result.filter(pk__in=latest.values('pk'))
+        else:
+            #Correlated subquery fallback for backends like SQLite
+            latest = result.filter(**{key: OuterRef(key)})
+            latest = latest.order_by(f'-{order_field}', '-pk').values('pk')[:1]
+            result = result.filter(pk=Subquery(latest))
+
+        return result.order_by(f'-{key}')
+
+    @classmethod
+    def get_all_latest(cls, user=None, key=None, date=None):
+        """
+        user, if provided, filters results that are owned by user
+        key, if specified, is the hk to use. Defaults to cls.default_hk
+        """
+        return list(cls.get_latest_queryset(user, key, date))
 
     @classmethod
     def get_next_hk(cls):
-        if cls.objects.count() == 0:
+        """
+        Call this with KeyLock held for cls if the result is going to be saved
+        """
+        latest = cls.objects.aggregate(latest=Max('hk'))['latest']
+        if latest is None:
             return 0
-        latest = max(cls.objects.all(), key = lambda x: x.hk)
-        return latest.hk+1
+        return latest+1
         
 class Searchable():
 
-    def search_string(self):
+    #Short name used in search urls, and the text fields indexed as search
+    #terms in SearchEntry
+    search_name = None
+    search_fields = []
+
+    @classmethod
+    def search(cls, query, user=None):
+        """
+        Rows of {'key', 'text'} from the SearchEntry table for current versions
+        with a search field or key starting with query, newest first.
+        user, if provided, filters results owned by user.
+        """
+        result = SearchEntry.objects.filter(model_label=cls._meta.label_lower)
+        if user is not None:
+            result = result.filter(user=user)
+        if query != '':
+            result = result.filter(term__startswith=query.lower())
+        return result.values('key', 'text').distinct().order_by('-version__hk')
+
+    @classmethod
+    def get_search_url(cls, user=None):
+        """
+        The url of the search endpoint for this model, ready to have more
+        query parameters appended
+        """
+        result = reverse('comic:search', kwargs={'model': cls.search_name})
+        if user is not None:
+            return result + '?mine=1&'
+        return result + '?'
+
+    def search_label(self):
+        """
+        The search text without the owner's name
+        """
         return str(self)
 
+    def search_owner(self):
+        """
+        The alias whose name goes in the search text, if any
+        """
+        owner = getattr(self, 'owner', None)
+        return owner if isinstance(owner, Alias) else None
+
+    def search_string(self):
+        owner = self.search_owner()
+        if owner is None:
+            return self.search_label()
+        return f'{self.search_label()} ({owner.search_string()})'
+
+    def search_user_id(self):
+        return self.owner.owner.user_id
+
     def search_index(self):
         return getattr(self, self.default_hk)
 
@@ -164,12 +304,269 @@ def history_post_save(**kwargs):
     instance = kwargs['instance']
     
     if isinstance(instance, OwnedHistory):
+        identity_map.clear()
         if instance.hk is None:
             instance.hk = instance.pk
             instance.save(force_update = True)
+        else:
+            CurrentVersion.point_at(instance)
+            if isinstance(instance, Searchable):
+                SearchEntry.index(instance)
+            if isinstance(instance, Alias):
+                SearchEntry.reindex_owned(instance)
 
 model_signals.post_save.connect(history_post_save)
 
+class CurrentVersion(models.Model):
+    """
+    Records which row is the current version of each historical entity, so
+    that latest lookups are a single join instead of a sort over the whole
+    history of that entity.
+
+    Rows are keyed by the model label and the value of the model's default_hk
+    and are kept up to date by history_post_save. Reads only go through this
+    table when settings.COMIC_CURRENT_VERSIONS is True; use the
+    rebuild_current_versions and check_current_versions management commands
+    to populate and verify it for existing history.
+    """
+    model_label = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    version = models.ForeignKey(OwnedHistory, on_delete = models.CASCADE, related_name = 'current_for')
+
+    class Meta:
+        unique_together = ('model_label', 'key')
+
+    def __str__(self):
+        return f'{self.model_label} {self.key} -> {self.version_id}'
+
+    @classmethod
+    def point_at(cls, instance):
+        """
+        Mark instance as the current version of its historical key.
+        """
+        cls.objects.update_or_create(
+                model_label = instance._meta.label_lower,
+                key = str(instance.get_hk_value()),
+                defaults = {'version_id': instance.pk})
+
+    @staticmethod
+    def history_models():
+        """
+        All concrete OwnedHistory subclasses that get pointers
+        """
+        return [x for x in apps.get_app_config('comic').get_models()
+                    if issubclass(x, OwnedHistory) and x is not OwnedHistory]
+
+    @classmethod
+    def expected_map(cls, model):
+        """
+        Compute {key: version pk} for model directly from its history.
+        """
+        result = model.get_latest_queryset()
+        return {str(x.get_hk_value()): x.pk for x in result}
+
+    @classmethod
+    def rebuild(cls, model):
+        """
+        Replace all pointers for model with ones computed from its history.
+        Returns the number of pointers written.
+        """
+        label = model._meta.label_lower
+        expected = cls.expected_map(model)
+        with transaction.atomic():
+            cls.objects.filter(model_label = label).delete()
+            cls.objects.bulk_create(
+                [cls(model_label = label, key = k, version_id = v) for k,v in expected.items()],
+                batch_size = 500)
+        return len(expected)
+
+    @classmethod
+    def find_inconsistencies(cls, model):
+        """
+        Compare the pointers for model against its history.
+        Returns a list of (key, pointer pk, expected pk) for every key where
+        they disagree; a pk of None means that side is missing.
+        """
+        label = model._meta.label_lower
+        expected = cls.expected_map(model)
+        actual = dict(cls.objects.filter(model_label = label).values_list('key', 'version_id'))
+
+        result = []
+        for key in sorted(expected.keys() | actual.keys()):
+            if expected.get(key) != actual.get(key):
+                result.append((key, actual.get(key), expected.get(key)))
+        return result
+
+class SearchEntry(models.Model):
+    """
+    The search text of the current version of each Searchable entity, so
+    that autocomplete lookups are a single indexed prefix query and their
+    results can be rendered without loading any entities.
+
+    There is a row per lowercased search term (the key and each of the
+    model's search_fields), each carrying the full search_string as text.
+    The owner's name is the only part of text that depends on another
+    entity, so label and owner_hk keep the rest of it and whose name it is,
+    and renaming an alias rewrites its entities' rows in one UPDATE.
+    Rows are kept up to date by history_post_save; use the
+    rebuild_search_index management command to populate the table for
+    existing history.
+    """
+    model_label = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    term = models.CharField(max_length=255)
+    text = models.TextField()
+    label = models.TextField(default = '')
+    owner_hk = models.IntegerField(null = True)
+    version = models.ForeignKey(OwnedHistory, on_delete = models.CASCADE, related_name = 'search_entries')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete = models.CASCADE, related_name = '+')
+
+    class Meta:
+        indexes = [
+            #pattern ops let PostgreSQL use the index for LIKE 'prefix%'
+            models.Index(fields=['model_label', 'term'], name='search_label_term',
+                opclasses=['varchar_pattern_ops', 'varchar_pattern_ops']),
+            models.Index(fields=['model_label', 'key'], name='search_label_key'),
+            models.Index(fields=['owner_hk'], name='search_owner'),
+        ]
+
+    def __str__(self):
+        return f'{self.model_label} {self.key}: {self.term}'
+
+    @staticmethod
+    def choice(row):
+        """
+        The (search_key, search_string) pair for a row returned by
+        Searchable.search
+        """
+        return (f'{row["key"]}: {row["text"]}', row['text'])
+
+    @staticmethod
+    def searchable_models():
+        return [x for x in CurrentVersion.history_models() if issubclass(x, Searchable)]
+
+    @classmethod
+    def entries_for(cls, instance):
+        """
+        Unsaved rows for instance, which should be the current version
+        """
+        key = str(instance.get_hk_value())
+        text = instance.search_string()
+        label = instance.search_label()
+        owner = instance.search_owner()
+        owner_hk = owner.hk if owner is not None else None
+        user_id = instance.search_user_id()
+
+        terms = {key.lower()}
+        for field in instance.search_fields:
+            value = getattr(instance, field)
+            if value:
+                terms.add(value.lower()[:255])
+
+        return [cls(model_label = instance._meta.label_lower, key = key,
+                    term = x, text = text, label = label, owner_hk = owner_hk,
+                    version_id = instance.pk, user_id = user_id) for x in terms]
+
+    @classmethod
+    def index(cls, instance):
+        """
+        Replace the rows for instance's key with ones for instance.
+        """
+        with transaction.atomic():
+            cls.objects.filter(
+                    model_label = instance._meta.label_lower,
+                    key = str(instance.get_hk_value())).delete()
+            cls.objects.bulk_create(cls.entries_for(instance))
+
+    @classmethod
+    def reindex_owned(cls, alias):
+        """
+        The search text of everything includes its owner's name, so put
+        alias's current name into the rows of everything it owns
+        """
+        text = Concat('label', Value(f' ({alias.search_string()})'), output_field = models.TextField())
+        cls.objects.filter(owner_hk = alias.hk).update(text = text)
+
+    @classmethod
+    def rebuild(cls, model):
+        """
+        Replace all rows for model with ones computed from its history.
+        Returns the number of entities indexed.
+        """
+        label = model._meta.label_lower
+        current = list(model.get_latest_queryset())
+        with transaction.atomic():
+            cls.objects.filter(model_label = label).delete()
+            for instance in current:
+                cls.objects.bulk_create(cls.entries_for(instance))
+        return len(current)
+
+class KeyLock(models.Model):
+    """
+    A row per history model that is locked while a new key is chosen and the
+    entity using it is saved, so that concurrent creates can't both pick the
+    same key.
+    """
+    name = models.CharField(max_length=100, unique=True)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def acquire(cls, model):
+        """
+        Lock the key for model until the end of the current transaction.
+        Must be called inside transaction.atomic().
+        """
+        name = model._meta.label_lower
+        cls.objects.get_or_create(name=name)
+        cls.objects.select_for_update().get(name=name)
+
+class Checkpoint(models.Model):
+    """
+    A row per periodic job, recording the time up to which it has handled
+    everything, so that the next run can carry on from there
+    """
+    name = models.CharField(max_length=100, unique=True)
+    date = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.name} {self.date}'
+
+    @classmethod
+    def get(cls, name):
+        return cls.objects.filter(name=name).values_list('date', flat=True).first()
+
+    @classmethod
+    def set(cls, name, date):
+        cls.objects.update_or_create(name=name, defaults={'date': date})
+
+class Generation(models.Model):
+    """
+    A counter per shared in-memory structure, bumped whenever the structure
+    changes, so that every process can tell whether its copy is current
+    """
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.name} {self.value}'
+
+    @classmethod
+    def get(cls, name):
+        return cls.objects.filter(name=name).values_list('value', flat=True).first()
+
+    @classmethod
+    def bump(cls, name):
+        """
+        Increment the counter for name, returning its new value
+        """
+        with transaction.atomic():
+            if cls.objects.filter(name=name).update(value=F('value') + 1) == 0:
+                cls.objects.get_or_create(name=name)
+                cls.objects.filter(name=name).update(value=F('value') + 1)
+            return cls.get(name)
+
 class HistoryText(OwnedHistory):
     
     main = models.TextField()
@@ -192,13 +589,39 @@ class Alias(OwnedHistory, Searchable):
     display_name = models.TextField()
     owner = models.ForeignKey(Author, on_delete = models.CASCADE, related_name = 'aliases')
 
+    search_name = 'alias'
+    search_fields = ['display_name']
+
     conflict_icon = '⚠'
     warning = f'<span title="This name is used by multiple authors">{conflict_icon}</span>'
 
-    def is_conflicted(self, date):
-        vals =  Alias.get_all_latest(date=date)
-        vals = list(filter(lambda x: x.display_name == self.display_name, vals))
-        return len(vals) > 1
+    def is_conflicted(self, date, conflicts=None):
+        """
+        True if more than one author uses this display name as of date.
+        conflicts, if provided, is an index from get_conflict_index.
+        """
+        if conflicts is None:
+            conflicts = Alias.get_conflict_index(date)
+        return len(conflicts.get(self.display_name, ())) > 1
+
+    @classmethod
+    def get_conflict_index(cls, date):
+        """
+        Map every display name to the set of author ids using it as of date.
+        This is built with a single query and kept for the rest of the request.
+        """
+        cache_key = ('conflicts', Alias, date)
+        cached = identity_map.get(cache_key)
+        if cached is not None:
+            return cached
+
+        result = {}
+        names = cls.get_latest_queryset(date=date).values_list('display_name', 'owner_id')
+        for display_name, owner_id in names:
+            result.setdefault(display_name, set()).add(owner_id)
+
+        identity_map.put(cache_key, result)
+        return result
 
     def is_owned_by(self, user):
         return self.owner.user == user
@@ -215,10 +638,47 @@ class Alias(OwnedHistory, Searchable):
         Returns a dictionary of values that can be used to safely render aliases
         in user-generated templates.
         """
-        result = {}
+        cache_key = ('sanitize', Alias, self.hk, date)
+        cached = identity_map.get(cache_key)
+        if cached is not None:
+            return cached
+
         self = self.as_of(date)
+        result = self.get_safe_names(Alias.get_conflict_index(date))
+
+        identity_map.put(cache_key, result)
+        return result
+
+    @classmethod
+    def sanitize_batch(cls, aliases, date):
+        """
+        Sanitize several aliases at once, fetching all of their versions as of
+        date in one query. Returns a list of sanitize results in the same
+        order as aliases.
+        """
+        results = {}
+        for hk in {x.hk for x in aliases}:
+            cached = identity_map.get(('sanitize', Alias, hk, date))
+            if cached is not None:
+                results[hk] = cached
+
+        missing = {x.hk for x in aliases} - results.keys()
+        if len(missing) > 0:
+            conflicts = cls.get_conflict_index(date)
+            for entry in cls.get_latest_queryset(date=date).filter(hk__in=missing):
+                results[entry.hk] = entry.get_safe_names(conflicts)
+                identity_map.put(('sanitize', Alias, entry.hk, date), results[entry.hk])
+
+        return [results[x.hk] for x in aliases]
+
+    def get_safe_names(self, conflicts):
+        """
+        The sanitize dictionary for this exact version of the alias, given a
+        conflict index from get_conflict_index.
+        """
+        result = {}
         display_name_safe = django.utils.html.conditional_escape(self.display_name)
-        if not self.is_conflicted(date):
+        if not self.is_conflicted(None, conflicts):
             result['simple_name'] = display_name_safe
             result['html_name'] = display_name_safe
         else:
@@ -238,6 +698,9 @@ class Alias(OwnedHistory, Searchable):
         self = self.as_of()
         return f'{self.display_name}'
 
+    def search_user_id(self):
+        return self.owner.user_id
+
 
 ### Comic Customization ###
 
@@ -246,11 +709,14 @@ class PageTemplate(OwnedHistory, Searchable):
     name = models.TextField()
     template = models.TextField(blank=True, null=True)
 
+    search_name = 'template'
+    search_fields = ['name']
+
     def __str__(self):
         return f'{self.name} ({self.owner}) as of {self.created_at}'
 
-    def search_string(self):
-        return f'{self.name} ({self.owner.search_string()})'
+    def search_label(self):
+        return self.name
 
 class PageTheme(OwnedHistory, Searchable):
     owner = models.ForeignKey(Alias, on_delete = models.CASCADE, related_name = 'owned_themes')
@@ -267,6 +733,9 @@ class PageTheme(OwnedHistory, Searchable):
     meta_left = models.TextField(null=True, blank=True)
     meta_right= models.TextField(null=True, blank=True)
 
+    search_name = 'theme'
+    search_fields = ['name']
+
     keys = [
             'extra_rss_links', 'left_links', 'center_links', 'right_links', 'nav_right',
             'meta_left', 'meta_right',
@@ -278,14 +747,14 @@ class PageTheme(OwnedHistory, Searchable):
             template = getattr(self, key)
             if template is None or len(template) == 0:
                 continue
-            result[key] = Template(template) 
+            result[key] = template_cache.get_template(('theme', self.pk, key), template)
         return result 
 
     def __str__(self):
         return f'{self.name} ({self.owner}) as of {self.created_at}'
 
-    def search_string(self):
-        return f'{self.name} ({self.owner.search_string()})'
+    def search_label(self):
+        return self.name
 
 
 
@@ -299,8 +768,11 @@ class ComicArc(OwnedHistory, Searchable):
     def __str__(self):
         return f'{self.display_name} ({self.slug_name}) - {self.owner}'
 
-    def search_string(self):
-        return f'{self.display_name} ({self.slug_name}) ({self.owner.search_string()})'
+    def search_label(self):
+        return f'{self.display_name} ({self.slug_name})'
+
+    search_name = 'arc'
+    search_fields = ['display_name', 'slug_name']
 
     class Meta:
         unique_together = ('slug_name', 'display_name')
@@ -319,7 +791,20 @@ class ComicPage(OwnedHistory, Searchable):
     title = models.TextField(blank = True, null = True)
     arc = models.ForeignKey(ComicArc, on_delete = models.CASCADE)
 
-    image = models.ImageField(upload_to='images')
+    image = models.ImageField(upload_to='images', storage=get_image_storage)
+    #Recorded when the image is uploaded so describing it never touches storage
+    image_size = models.PositiveBigIntegerField(null = True, editable = False)
+    image_mime_type = models.CharField(max_length = 100, null = True, editable = False)
+    image_width = models.PositiveIntegerField(null = True, editable = False)
+    image_height = models.PositiveIntegerField(null = True, editable = False)
+
+    #A version with publish_at in the future stays hidden from readers until
+    #then. released_at is when it became or becomes visible, whichever of
+    #publish_at and the save is later, so reads can filter on one column.
+    publish_at = models.DateTimeField(blank = True, null = True)
+    released_at = models.DateTimeField(null = True, editable = False)
+    release_field = 'released_at'
+
     alt_text = models.TextField(blank = True, null = True)
 
     transcript = models.TextField(blank=True, null=True)
@@ -328,25 +813,58 @@ class ComicPage(OwnedHistory, Searchable):
 
     theme = models.ForeignKey(PageTheme, on_delete = models.CASCADE)
 
+    class Meta:
+        #created_at lives in the OwnedHistory table, so it can't share an
+        #index with page_key; history_hk_created covers the ordering.
+        #page_key_released also serves lookups by page_key alone.
+        indexes = [
+            models.Index(fields=['page_key', 'released_at'], name='page_key_released'),
+            models.Index(fields=['released_at'], name='page_released'),
+            models.Index(fields=['publish_at'], name='page_publish_at'),
+        ]
+
+    search_name = 'page'
+    search_fields = ['page_key', 'title']
+
     def save(self, *args, **kwargs):
-        print(f'A Page history was saved: {self} {kwargs=}')
+        logger.debug('A page history was saved: %s %s', self, kwargs)
+        if self.image and (not self.image._committed or self.image_size is None):
+            self.record_image_info()
         stamp = datetime.datetime.utcnow()
         force_update = kwargs.get('force_update', False)
+        if not force_update or self.released_at is None:
+            self.released_at = self.get_release_time()
         if not force_update and self.pk is not None:
             self.created_at = stamp
 
-            
-            self._old_from = list(self.links_from.all())
-            self._old_to = list(self.links_to.all())
+            #page_post_save moves the live links over from this version
+            self._old_pk = self.pk
  
             self.pk = None
             self.id = None
  
             kwargs['force_insert'] = True
-            models.Model.save(self, *args, **kwargs)
+            with transaction.atomic():
+                models.Model.save(self, *args, **kwargs)
         else:
             models.Model.save(self, *args, **kwargs)
 
+    def get_release_time(self):
+        now = django.utils.timezone.now()
+        if self.publish_at is not None and self.publish_at > now:
+            return self.publish_at
+        return now
+
+    def record_image_info(self):
+        """
+        Fill in the image description columns. For a new upload this reads
+        the uploaded file rather than storage.
+        """
+        self.image_size = self.image.size
+        self.image_mime_type = mimetypes.guess_type(self.image.name)[0]
+        self.image_width = self.image.width
+        self.image_height = self.image.height
+
     def can_link(self, kind, user):
         """
         Return True if the given user is allowed to add a from link of the
@@ -354,7 +872,7 @@ class ComicPage(OwnedHistory, Searchable):
         kind is 'p' or 'n'.
         """
         assert kind in ['n', 'p']
-        existing = self.links_from.filter(kind=kind).all()
+        existing = ComicLink.get_links_from(self).filter(kind=kind, deleted_at__isnull=True)
         page_user = self.owner.owner.user
         total = len(existing)
         if page_user == user:
@@ -362,13 +880,24 @@ class ComicPage(OwnedHistory, Searchable):
         else:
             existing = list(filter(lambda x: not x.is_owned_by(page_user), existing))
 
-        print(f'{existing=}')
+        logger.debug('Existing %s links from %s counted against %s: %s', kind, self, user, existing)
 
         if len(existing) < 2 and total < 3: 
             return True
 
-    def search_string(self):
-        return f'Page {self.page_key}: {self.title} ({self.owner.search_string()})'
+    def take_links(self):
+        """
+        Move the live links on this page's other versions over to this one,
+        with one UPDATE per direction. Only needed for links addressed by
+        page version.
+        """
+        others = ComicPage.objects.filter(page_key=self.page_key).exclude(pk=self.pk).values('pk')
+        live = ComicLink.objects.filter(deleted_at__isnull=True)
+        live.filter(from_page_id__in=others).update(from_page=self)
+        live.filter(to_page_id__in=others).update(to_page=self)
+
+    def search_label(self):
+        return f'Page {self.page_key}: {self.title}'
 
     def __str__(self):
         self.old_from = self.links_from.all()
@@ -379,16 +908,66 @@ class ComicPage(OwnedHistory, Searchable):
     def get_absolute_url(self):
         return reverse('comic:page', kwargs={'pk': self.page_key})
 
+    @property
+    def image_variants(self):
+        """
+        {variant name: ImageVariant} for the derivatives of this page's
+        image that have been generated so far
+        """
+        result = self.__dict__.get('_image_variants')
+        if result is None:
+            result = ImageVariant.get_variants(self.image.name)
+            self._image_variants = result
+        return result
+
+    def get_image(self, name=None):
+        """
+        The named variant of this page's image if it has been generated,
+        otherwise the original; either way something with url, size and
+        mime_type
+        """
+        variant = self.image_variants.get(name, None)
+        if variant is not None:
+            return variant
+        return ImageVariant.for_original(self)
+
+    def get_image_sources(self):
+        """
+        The generated variants named in settings.COMIC_PAGE_IMAGE_SOURCES,
+        grouped by format in order of preference, for <source> elements ahead
+        of the original. Each is a dict of mime_type, srcset with a width
+        descriptor per variant, and sizes.
+        """
+        names = getattr(settings, 'COMIC_PAGE_IMAGE_SOURCES', [])
+        by_type = {}
+        for variant in [self.image_variants[x] for x in names if x in self.image_variants]:
+            by_type.setdefault(variant.mime_type, {})[variant.width] = variant
+
+        sizes = '100vw'
+        if self.image_width is not None:
+            sizes = f'(max-width: {self.image_width}px) 100vw, {self.image_width}px'
+        result = []
+        for mime_type, variants in by_type.items():
+            srcset = ', '.join(f'{x.url} {x.width}w' for _, x in sorted(variants.items()))
+            result.append({'mime_type': mime_type, 'srcset': srcset, 'sizes': sizes})
+        return result
+
     def render_template(self, date, template_text = None, context=None):
+        cache_key = None
         if template_text is None:
-            template_text = self.template.as_of(date).template
+            page_template = self.template.as_of(date)
+            template_text = page_template.template
+            cache_key = ('template', page_template.pk)
 
         if template_text is not None and len(template_text) > 0:
             if context is None:
                 context = Context({'object': self})
             else:
                 context= Context(context)
-            template = Template(template_text)
+            if cache_key is None:
+                template = template_cache.get_template_for_text(template_text)
+            else:
+                template = template_cache.get_template(cache_key, template_text)
             return template.render(context)
 
     def render_theme(self, date, theme_dict = None, context = None):
@@ -408,52 +987,74 @@ class ComicPage(OwnedHistory, Searchable):
 
 
     def sanitize(self, date):
-        self.author = self.owner.sanitize(date)
+        #Every owner on the page gets sanitized in one batch
+        owned = [self, self.arc, self.template, self.theme]
+        owned += list(self.next_links) + list(self.prev_links) + list(self.first_links)
+        authors = Alias.sanitize_batch([x.owner for x in owned], date)
+        authors = {id(x): author for x, author in zip(owned, authors)}
+
+        self.author = authors[id(self)]
         self.owner = None
 
-        self.next_links = [x.sanitize(date) for x in self.next_links] 
-        self.prev_links = [x.sanitize(date) for x in self.prev_links] 
-        self.first_links = [x.sanitize(date) for x in self.first_links] 
+        self.next_links = [x.sanitize(date, authors[id(x)]) for x in self.next_links] 
+        self.prev_links = [x.sanitize(date, authors[id(x)]) for x in self.prev_links] 
+        self.first_links = [x.sanitize(date, authors[id(x)]) for x in self.first_links] 
 
-        self.arc = self.arc.sanitize(date)
+        self.arc = self.arc.sanitize(date, authors[id(self.arc)])
 
-        self.template = self.template.sanitize(date)
-        self.theme = self.theme.sanitize(date)
+        self.template = self.template.sanitize(date, authors[id(self.template)])
+        self.theme = self.theme.sanitize(date, authors[id(self.theme)])
 
         return self
 
     @classmethod
-    def get_view_page(cls, date, page_key_str, sanitize = True):
+    def get_view_page(cls, date, page_key_str, sanitize = True, released = True):
         """
         Retrieve a comic page by its page key and the target date.
         If the page exists, prepare it for rendering by a template
+        released, if False, also finds versions that aren't published yet,
+        for their authors
         """
+        order_field = cls.release_field if released else 'created_at'
         try:
             page_key = cls.clean_page_key(page_key_str)
             pages =  cls.objects.filter(
-                        page_key=page_key).order_by(
-                        '-created_at').filter(created_at__lte=date)
-            result = pages[0]
-            result.first_version = pages.order_by('created_at')[0]
+                        page_key=page_key).filter(**{f'{order_field}__lte': date})
+            result = pages.select_related(
+                        'owner', 'arc', 'template__owner', 'theme__owner').order_by(
+                        f'-{order_field}', '-created_at', '-pk')[0]
+            result.first_version = pages.only('created_at').order_by(
+                        order_field, 'created_at', 'pk')[0]
         except ValueError:
             raise
         except IndexError:
             return None
 
-        print(date)
+        logger.debug('Viewing page %s as of %s', page_key, date)
 
         result.owner = result.owner.as_of(date)
 
-        print(result.links_from.all())
-        for entry in result.links_from.all():
-            print(entry.deleted_at)
-            print(entry.created_at)
-        links_from = result.links_from.exclude(deleted_at__lte=date).exclude(created_at__gt=date)
-        print(links_from)
-
-        result.next_links = links_from.filter(kind='n')
-        result.prev_links = links_from.filter(kind='p')
-        result.first_links = links_from.filter(kind='f')
+        #All live links in one query, split up by kind here
+        links_from = ComicLink.get_links_from(result)
+        links_from = links_from.exclude(deleted_at__lte=date).exclude(created_at__gt=date)
+        if ComicLink.by_page_key():
+            links_from = ComicLink.resolve_pages(list(links_from.select_related('owner')), date)
+        else:
+            #Leave out links to pages that haven't been published yet
+            published = cls.objects.filter(released_at__lte=date).values('page_key')
+            links_from = links_from.filter(Q(to_key__isnull=True) | Q(to_key__in=published))
+            links_from = links_from.select_related('owner', 'to_page')
+
+        result.next_links = []
+        result.prev_links = []
+        result.first_links = []
+        by_kind = {
+            'n': result.next_links,
+            'p': result.prev_links,
+            'f': result.first_links,
+            }
+        for entry in links_from:
+            by_kind[entry.kind].append(entry)
 
         def order_key(x):
             return [x.owner.hk != result.owner.hk, x.created_at]
@@ -468,6 +1069,31 @@ class ComicPage(OwnedHistory, Searchable):
             result = result.sanitize(date)
         return result
 
+    @classmethod
+    def get_last_modified(cls, date=None, forums=True):
+        """
+        The most recent change, as of date, to anything that a rendered page
+        can show: any history entity, any page release, any link creation or
+        deletion, and optionally any forum post. Returns None if there is
+        nothing at all.
+
+        This is a few aggregate queries, so it is much cheaper than rendering.
+        """
+        if date is None:
+            date = django.utils.timezone.now()
+        stamps = [
+            OwnedHistory.objects.filter(created_at__lte=date).aggregate(x=Max('created_at'))['x'],
+            cls.objects.filter(released_at__lte=date).aggregate(x=Max('released_at'))['x'],
+            ComicLink.objects.filter(created_at__lte=date).aggregate(x=Max('created_at'))['x'],
+            ComicLink.objects.filter(deleted_at__lte=date).aggregate(x=Max('deleted_at'))['x'],
+            ]
+        if forums:
+            stamps.append(ForumPost.objects.filter(timestamp__lte=date).aggregate(x=Max('timestamp'))['x'])
+        stamps = [x for x in stamps if x is not None]
+        if len(stamps) == 0:
+            return None
+        return max(stamps)
+
     @classmethod
     def get_test_page(cls):
         return cls.objects.all()[0]
@@ -504,11 +1130,15 @@ class ComicPage(OwnedHistory, Searchable):
 
     @classmethod
     def get_next_page_key(cls):
-        keys = [int(x.page_key, 16) for x in cls.objects.all()]
-        try:
-            latest = max(keys)
-        except ValueError:
+        """
+        Call this with KeyLock held for ComicPage if the result is going to be
+        saved. Page keys are fixed width lower case hex, so the largest string
+        is also the largest number.
+        """
+        latest = cls.objects.aggregate(latest=Max('page_key'))['latest']
+        if latest is None:
             return cls.fmt_page_key(0)
+        latest = int(latest, 16)
         if latest >= 0xffff:
             raise RuntimeError('Out of keys')
         return cls.fmt_page_key(latest+1)
@@ -516,29 +1146,105 @@ class ComicPage(OwnedHistory, Searchable):
 
 def page_post_save(**kwargs):
     """
-    When a new History instance is created, and the hk hasn't been set
-    (it should not be set manually), the hk will be updated to match the pk
+    When a new version of a ComicPage is saved, the links that are still live
+    on its other versions are moved over to the new one, inside the
+    transaction ComicPage.save opens. A version scheduled for later leaves
+    them where readers see them until releases.release moves them. Links
+    addressed by page key don't need moving.
     """
     instance = kwargs['instance']
     
     if isinstance(instance, ComicPage):
-        try:
-            for entry in instance._old_from:
-                if entry.deleted_at is None:
-                    entry.from_page = instance
-                    entry.save()
-        except AttributeError:
-            pass #in the event there aren't any old from links
-        try:
-            for entry in instance._old_to:
-                if entry.deleted_at is None:
-                    entry.to_page = instance
-                    entry.save()
-        except AttributeError:
-            pass
+        link_graph.invalidate()
+
+        old_pk = instance.__dict__.pop('_old_pk', None)
+        if old_pk is None or ComicLink.by_page_key():
+            return
+        if instance.released_at > django.utils.timezone.now():
+            return
+
+        instance.take_links()
 
 model_signals.post_save.connect(page_post_save)
 
+def page_image_post_save(**kwargs):
+    """
+    Queue derivative generation for images that don't have any yet. Page
+    versions that reuse an earlier version's image find its variants.
+    """
+    instance = kwargs['instance']
+    if isinstance(instance, ComicPage) and instance.image:
+        if not ImageVariant.objects.filter(source=instance.image.name).exists():
+            image_variants.schedule(instance.image.name)
+
+model_signals.post_save.connect(page_image_post_save)
+
+def feed_post_save(**kwargs):
+    """
+    Regenerate the static feeds a page, arc or alias save affects. A new
+    entity is saved again once its hk is set, so wait for that.
+    """
+    instance = kwargs['instance']
+    if isinstance(instance, (ComicPage, ComicArc, Alias)) and instance.hk is not None:
+        static_feeds.schedule(instance)
+
+model_signals.post_save.connect(feed_post_save)
+
+
+class ImageVariant(models.Model):
+    """
+    A resized or re-encoded copy of an uploaded page image, made by
+    image_variants.generate. source is the storage name of the original;
+    file lives under a path derived from the original's contents, so several
+    sources with the same contents share files.
+    """
+    source = models.CharField(max_length=255)
+    name = models.CharField(max_length=50)
+    digest = models.CharField(max_length=64)
+    file = models.FileField(max_length=255)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    size = models.PositiveBigIntegerField()
+    mime_type = models.CharField(max_length=100)
+
+    class Meta:
+        unique_together = ('source', 'name')
+
+    def __str__(self):
+        return f'{self.source} {self.name}'
+
+    @property
+    def url(self):
+        return self.file.url
+
+    @classmethod
+    def get_variants(cls, source):
+        return {x.name: x for x in cls.objects.filter(source=source)}
+
+    @classmethod
+    def attach(cls, pages):
+        """
+        Load the variants of all of pages' images in one query
+        """
+        by_source = {x.image.name: {} for x in pages}
+        for variant in cls.objects.filter(source__in=by_source.keys()):
+            by_source[variant.source][variant.name] = variant
+        for page in pages:
+            page._image_variants = by_source[page.image.name]
+        return pages
+
+    @classmethod
+    def for_original(cls, page):
+        """
+        An unsaved stand-in for page's original upload
+        """
+        if page.image_size is None:
+            #Not back-filled yet
+            page.record_image_info()
+        return cls(source = page.image.name, name = '', file = page.image.name,
+                   width = page.image_width, height = page.image_height,
+                   size = page.image_size, mime_type = page.image_mime_type)
+
 
 
 class ComicLink(models.Model):
@@ -558,6 +1264,75 @@ class ComicLink(models.Model):
     to_page = models.ForeignKey(ComicPage, on_delete = models.CASCADE, related_name = 'links_to')
     kind = models.TextField(choices=LINK_KINDS.items())
 
+    #The stable page keys of from_page and to_page, filled in on save.
+    #With settings.COMIC_LINKS_BY_PAGE_KEY links are addressed by these
+    #instead, so they don't have to be moved when a page gets a new version.
+    from_key = models.TextField(blank=True, null=True, editable=False)
+    to_key = models.TextField(blank=True, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['from_page', 'kind', 'deleted_at', 'created_at'], name='link_from_kind_dates'),
+            models.Index(fields=['from_key', 'kind', 'deleted_at', 'created_at'], name='link_fromkey_kind_dates'),
+            #For the Max() aggregates in ComicPage.get_last_modified
+            models.Index(fields=['created_at'], name='link_created'),
+            models.Index(fields=['deleted_at'], name='link_deleted'),
+        ]
+
+    def save(self, *args, **kwargs):
+        pages = ComicPage.objects.values_list('page_key', flat=True)
+        if self.from_key is None:
+            self.from_key = pages.get(pk=self.from_page_id)
+        if self.to_key is None:
+            self.to_key = pages.get(pk=self.to_page_id)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def by_page_key():
+        return getattr(settings, 'COMIC_LINKS_BY_PAGE_KEY', False)
+
+    @classmethod
+    def get_links_from(cls, page):
+        """
+        All links from page, by page key or by page version depending on the
+        addressing mode
+        """
+        if cls.by_page_key():
+            return cls.objects.filter(from_key=page.page_key)
+        return page.links_from.all()
+
+    @classmethod
+    def resolve_pages(cls, links, date):
+        """
+        Point to_page of each link at the version of its target page that was
+        current as of date, using one query for all of them. Links to pages
+        that weren't published as of date are left out.
+        """
+        keys = {x.to_key for x in links}
+        pages = ComicPage.get_latest_queryset(date=date).filter(page_key__in=keys)
+        pages = {x.page_key: x for x in pages}
+        result = []
+        for entry in links:
+            if entry.to_key in pages:
+                entry.to_page = pages[entry.to_key]
+                result.append(entry)
+            elif entry.to_key is None:
+                result.append(entry)
+        return result
+
+    @classmethod
+    def backfill_keys(cls):
+        """
+        Fill in from_key and to_key for links saved before they existed.
+        Returns the number of links updated.
+        """
+        def page_key(field):
+            return Subquery(ComicPage.objects.filter(pk=OuterRef(field)).values('page_key')[:1])
+
+        result = cls.objects.filter(from_key__isnull=True).update(from_key=page_key('from_page_id'))
+        result += cls.objects.filter(to_key__isnull=True).update(to_key=page_key('to_page_id'))
+        return result
+
     def kind_name(self):
         return self.LINK_KINDS[self.kind]
 
@@ -568,13 +1343,15 @@ class ComicLink(models.Model):
     def filter_owner(queryset, user):
         return queryset.filter(owner__owner__user=user)
 
-    def sanitize(self, date):
-        self.author = self.owner.sanitize(date)
+    def sanitize(self, date, author=None):
+        if author is None:
+            author = self.owner.sanitize(date)
+        self.author = author
         self.owner = None
         return self
 
     @classmethod
-    def get_all_latest(cls, user, key=None):
+    def get_latest_queryset(cls, user=None, key=None):
         result = cls.objects
         result = result.filter(deleted_at__isnull=True)
         if user is not None:
@@ -582,11 +1359,23 @@ class ComicLink(models.Model):
         result = result.order_by('-created_at')
    
         return result
+
+    @classmethod
+    def get_all_latest(cls, user, key=None):
+        return cls.get_latest_queryset(user, key)
      
 
     def __str__(self):
         return f'{self.kind} {self.from_page} to {self.to_page} ({self.owner})'
     
+def link_graph_post_save(**kwargs):
+    """
+    Keep the reading order graph up to date as links are created and deleted
+    """
+    link_graph.link_changed(kwargs['instance'])
+
+model_signals.post_save.connect(link_graph_post_save, sender=ComicLink)
+
 ### Forums ###
 
 class ForumPost(models.Model):
@@ -597,6 +1386,12 @@ class ForumPost(models.Model):
     timestamp = models.DateTimeField(auto_now = True)
     source = models.ForeignKey(ComicPage, on_delete = models.CASCADE, related_name = 'forum_posts')
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['source', 'timestamp'], name='forum_source_timestamp'),
+            models.Index(fields=['timestamp'], name='forum_timestamp'),
+        ]
+
     def empty(self):
         return self.text.strip() == '';
 
@@ -0,0 +1,71 @@
+"""
+A rendered HTML cache for the reader page view.
+
+A page view depends on the page, its links, and the aliases, arcs, templates,
+themes and forum posts around it, and any of those can change which version
+of them is current. Rather than tracking every version id a render touched,
+current renders are keyed by the last modification time of all of those
+(ComicPage.get_last_modified), which any save or scheduled release moves. A
+change therefore misses every current render at once, in every process,
+without anything having to be invalidated; the old renders just expire.
+
+Views of a date in the past never change, since history is append only, so
+they are keyed by their path and date alone. They are still only kept for
+settings.COMIC_PAGE_CACHE_PAST_TIMEOUT, since any number of dates can be
+asked for. Views pass in a path built from the page, the normalized date and
+the query parameters they render with, so other parameters in a url don't
+make new entries.
+
+Only anonymous views are cached. The forum form needs a per-visitor CSRF
+token, so pages are rendered and stored with a placeholder in its place and
+the real token is substituted on the way out.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+CSRF_PLACEHOLDER = 'comic-page-cache-csrf-placeholder'
+
+
+def get_cache():
+    return caches[getattr(settings, 'COMIC_PAGE_CACHE', 'default')]
+
+def get_key(path, historical, last_modified):
+    """
+    The cache key for a render of path, which includes whatever the render
+    depends on from the querystring. historical is True for views of a date
+    in the past, which are keyed by path alone; current renders are keyed by
+    last_modified as well.
+    """
+    if historical:
+        return f'comic:page:past:{hashlib.sha256(path.encode()).hexdigest()}'
+    stamp = last_modified.isoformat() if last_modified is not None else ''
+    digest = hashlib.sha256(f'{path} {stamp}'.encode()).hexdigest()
+    return f'comic:page:{digest}'
+
+def get_page(request, key):
+    """
+    A response for request from the cache, or None on a miss
+    """
+    content = get_cache().get(key)
+    if content is None:
+        return None
+    return HttpResponse(content.replace(CSRF_PLACEHOLDER.encode(), get_token(request).encode()))
+
+def set_page(request, key, response, historical):
+    """
+    Store a response rendered with CSRF_PLACEHOLDER as its csrf_token, and
+    return it with the real token for request filled in.
+    """
+    response.render()
+    if historical:
+        timeout = getattr(settings, 'COMIC_PAGE_CACHE_PAST_TIMEOUT', 7*24*3600)
+    else:
+        timeout = getattr(settings, 'COMIC_PAGE_CACHE_TIMEOUT', 3600)
+    get_cache().set(key, response.content, timeout)
+
+    response.content = response.content.replace(CSRF_PLACEHOLDER.encode(), get_token(request).encode())
+    return response
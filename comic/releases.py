@@ -0,0 +1,120 @@
+"""
+Scheduled page releases.
+
+A ComicPage version saved with publish_at in the future stays hidden from
+readers until then. Nothing has to happen at that moment for readers to see
+it: every read filters on the release time, and current page renders are
+cached under the last modification time, which the release moves, while the
+static feeds written before it are treated as stale. But every cached render
+and feed would miss at once, so the release_pages management command waits
+for each release, then regenerates the feeds it affects and renders the pages
+that change, so that the first readers find them ready. Its progress is kept
+in a Checkpoint row, so runs from cron carry on from the last one.
+
+Links addressed by page version are the exception. Saving a version for later
+leaves them on the version readers see, and they only move over to it when
+release_pages releases it, or when the page is saved again after its release.
+So without settings.COMIC_LINKS_BY_PAGE_KEY, release_pages has to be running.
+
+Rendering ahead only helps readers if settings.COMIC_PAGE_CACHE is a cache
+shared with the web processes, such as memcached, redis or the database.
+"""
+import logging
+
+from django.contrib.auth.models import AnonymousUser
+from django.db.models import Min
+from django.http import Http404
+from django.urls import resolve, reverse
+
+from . import models
+from . import static_feeds
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT = 'release_pages'
+
+
+def get_due(since, until):
+    """
+    Scheduled page versions released after since, up to and including until
+    """
+    return models.ComicPage.objects.filter(
+            publish_at__isnull=False, released_at__gt=since, released_at__lte=until)
+
+def get_next(after):
+    """
+    The next release time after after, or None if nothing is scheduled
+    """
+    result = models.ComicPage.objects.filter(released_at__gt=after)
+    return result.aggregate(x=Min('released_at'))['x']
+
+def get_checked():
+    return models.Checkpoint.get(CHECKPOINT)
+
+def set_checked(date):
+    models.Checkpoint.set(CHECKPOINT, date)
+
+def get_warm_paths(pages):
+    """
+    Reader pages whose current render changes when pages are released: the
+    pages themselves, the pages linking to them, the front page and the
+    archive
+    """
+    keys = {x.page_key for x in pages}
+    links = models.ComicLink.objects.filter(deleted_at__isnull=True, to_key__in=keys)
+    keys |= set(links.exclude(from_key__isnull=True).values_list('from_key', flat=True))
+
+    result = [reverse('comic:index'), reverse('comic:archive')]
+    result += [reverse('comic:page', kwargs={'pk': x}) for x in sorted(keys)]
+    return result
+
+def warm(paths):
+    """
+    Render each path as an anonymous reader would, which stores it in the
+    page cache. Returns the number rendered.
+    """
+    base_url = static_feeds.get_base_url() or 'http://localhost'
+    result = 0
+    for path in paths:
+        request = static_feeds.OfflineRequest(base_url, path)
+        request.user = AnonymousUser()
+        match = resolve(path)
+        try:
+            response = match.func(request, *match.args, **match.kwargs)
+        except Http404:
+            continue
+        if hasattr(response, 'render'):
+            response.render()
+        result += 1
+    return result
+
+def take_links(pages):
+    """
+    Move the live links addressed by page version over to the newest of
+    pages for each page key, now that readers see it
+    """
+    if models.ComicLink.by_page_key():
+        return
+    newest = {}
+    for page in sorted(pages, key=lambda x: (x.released_at, x.created_at, x.pk)):
+        newest[page.page_key] = page
+    for page in newest.values():
+        page.take_links()
+
+def release(pages):
+    """
+    Bring everything that shows pages up to date now that they are
+    released. Returns the number of pages rendered ahead.
+    """
+    pages = list(pages.select_related('arc', 'owner'))
+    if len(pages) == 0:
+        return 0
+    logger.info('Releasing pages %s', ', '.join(x.page_key for x in pages))
+    take_links(pages)
+
+    if static_feeds.is_enabled():
+        paths = set()
+        for page in pages:
+            paths.update(static_feeds.get_page_paths(page))
+        static_feeds.regenerate(paths)
+    return warm(get_warm_paths(pages))
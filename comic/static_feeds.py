@@ -0,0 +1,292 @@
+"""
+Pre-rendered copies of the RSS and Atom feeds.
+
+Feed readers poll constantly, while the feeds only change when a page, arc or
+alias is saved. So after such a save commits, the affected feeds (the main
+feeds, and the per-arc and per-author feeds involved) are rendered once and
+written as files into settings.COMIC_FEED_ROOT (feeds/ under MEDIA_ROOT by
+default), named after their url path, e.g. rss.xml or atom-arc-3.xml. The web
+server can serve those directly; the feed views also serve them, through the
+page cache, and render live when there is no copy or when a page has been
+released since it was written. Each file's mtime is set to the last
+modification it was rendered at, so that is all it takes to tell.
+
+Rendering runs on a small pool of background threads, sized by
+settings.COMIC_STATIC_FEED_WORKERS, so the saving request doesn't wait for
+it. With no workers the affected copies are only dropped, and the feeds
+render live until the generate_feeds management command is run.
+
+Feeds contain absolute urls, so rendering them outside a request needs
+settings.COMIC_FEED_BASE_URL. Without it, the scheme and host of the last live
+feed request are used, and until there has been one, feeds are only dropped
+on save and left to render live.
+
+The generate_feeds management command writes every feed from scratch.
+"""
+import datetime
+import os
+import tempfile
+import urllib.parse
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.http import Http404, HttpRequest
+from django.urls import resolve, reverse
+
+from . import background
+from . import models
+from . import page_cache
+
+BASE_URL_KEY = 'comic:feed:base_url'
+
+#Stands in for every feed
+ALL = None
+
+EPOCH = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+
+
+class OfflineRequest(HttpRequest):
+    """
+    Enough of a request to render a feed or page outside of serving one,
+    with absolute urls built against base_url
+    """
+
+    def __init__(self, base_url, path):
+        super().__init__()
+        url = urllib.parse.urlsplit(base_url)
+        self.base_scheme = url.scheme
+        self.META['HTTP_HOST'] = url.netloc
+        self.method = 'GET'
+        self.path = self.path_info = path
+
+    def _get_scheme(self):
+        return self.base_scheme
+
+
+def is_enabled():
+    return getattr(settings, 'COMIC_STATIC_FEEDS', False)
+
+def get_root():
+    root = getattr(settings, 'COMIC_FEED_ROOT', None)
+    if root is None:
+        root = os.path.join(settings.MEDIA_ROOT, 'feeds')
+    return root
+
+def get_filename(path):
+    return os.path.join(get_root(), path.strip('/').replace('/', '-') + '.xml')
+
+def get_cache_key(path):
+    return f'comic:feed:{path}'
+
+def get_timeout():
+    #The files are the real copies; a process whose cache missed a
+    #regeneration picks the new file up within this long
+    return getattr(settings, 'COMIC_PAGE_CACHE_TIMEOUT', 3600)
+
+def get_base_url():
+    result = getattr(settings, 'COMIC_FEED_BASE_URL', None)
+    if result is None:
+        result = page_cache.get_cache().get(BASE_URL_KEY)
+    return result
+
+def remember_base_url(request):
+    """
+    Record where feeds are served from, for rendering them after saves
+    """
+    if not is_enabled() or getattr(settings, 'COMIC_FEED_BASE_URL', None) is not None:
+        return
+    base_url = f'{request.scheme}://{request.get_host()}'
+    cache = page_cache.get_cache()
+    if cache.get(BASE_URL_KEY) != base_url:
+        cache.set(BASE_URL_KEY, base_url, None)
+
+def get_entry(request):
+    """
+    The stored copy of the feed at request's path, as a dict of body,
+    content_type and last_modified, or None if it has to be rendered live.
+    Looked up once per request.
+    """
+    if not is_enabled() or request.method not in ('GET', 'HEAD') or request.GET:
+        return None
+    try:
+        return request._comic_static_feed
+    except AttributeError:
+        pass
+    request._comic_static_feed = load(request.path)
+    return request._comic_static_feed
+
+def get_released():
+    """
+    The latest page release up to now. A release changes the feeds without
+    any save, so copies written before it are stale.
+    """
+    pages = models.ComicPage.objects.filter(released_at__lte=django.utils.timezone.now())
+    return pages.aggregate(x=Max('released_at'))['x']
+
+def is_fresh(entry, released):
+    return released is None or entry['last_modified'] >= released
+
+def load(path):
+    released = get_released()
+    cache = page_cache.get_cache()
+    entry = cache.get(get_cache_key(path))
+    if entry is not None and is_fresh(entry, released):
+        return entry
+
+    #Another process may have written a newer copy
+    filename = get_filename(path)
+    try:
+        with open(filename, 'rb') as fp:
+            body = fp.read()
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    entry = {
+        'body': body,
+        'content_type': resolve(path).func.feed_type.content_type,
+        'last_modified': EPOCH + datetime.timedelta(microseconds=mtime // 1000),
+    }
+    if not is_fresh(entry, released):
+        return None
+    cache.set(get_cache_key(path), entry, get_timeout())
+    return entry
+
+def render(path, base_url):
+    """
+    Render the feed at path, returning (body, content_type)
+    """
+    match = resolve(path)
+    #The URLconf's Feed is shared by every request; views keep state on it
+    feed = type(match.func)()
+    request = OfflineRequest(base_url, path)
+    obj = feed.get_object(request, *match.args, **match.kwargs)
+    generator = feed.get_feed(obj, request)
+    return generator.writeString('utf-8').encode('utf-8'), generator.content_type
+
+def write(path, body, content_type, last_modified):
+    filename = get_filename(path)
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.feed-')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(body)
+    if last_modified is None:
+        last_modified = django.utils.timezone.now()
+    mtime = (last_modified - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+    os.utime(temp, ns=(mtime, mtime))
+    os.replace(temp, filename)
+
+    entry = {'body': body, 'content_type': content_type, 'last_modified': last_modified}
+    page_cache.get_cache().set(get_cache_key(path), entry, get_timeout())
+
+def remove(path):
+    page_cache.get_cache().delete(get_cache_key(path))
+    try:
+        os.remove(get_filename(path))
+    except FileNotFoundError:
+        pass
+
+def feed_paths(kind, hk=None):
+    """
+    The rss and atom paths of the main feed, or of an 'arc' or 'author' feed
+    """
+    if kind is None:
+        return [reverse('comic:rss'), reverse('comic:atom')]
+    return [reverse(f'comic:rss_{kind}', kwargs={'hk': hk}),
+            reverse(f'comic:atom_{kind}', kwargs={'hk': hk})]
+
+def get_all_paths():
+    result = feed_paths(None)
+    for hk in models.ComicArc.get_latest_queryset().values_list('hk', flat=True):
+        result += feed_paths('arc', hk)
+    for hk in models.Alias.get_latest_queryset().values_list('hk', flat=True):
+        result += feed_paths('author', hk)
+    return result
+
+def get_page_paths(page):
+    """
+    Feeds that a save of page can change: the main feeds, and those of the
+    arc and author of both the new and the previous version
+    """
+    versions = [page]
+    previous = models.ComicPage.objects.filter(page_key=page.page_key).exclude(pk=page.pk)
+    previous = previous.select_related('arc', 'owner').order_by('-created_at').first()
+    if previous is not None:
+        versions.append(previous)
+
+    result = feed_paths(None)
+    for arc_hk in {x.arc.hk for x in versions}:
+        result += feed_paths('arc', arc_hk)
+    for owner_hk in {x.owner.hk for x in versions}:
+        result += feed_paths('author', owner_hk)
+    return result
+
+def regenerate(paths=ALL):
+    """
+    Render and store the feeds at paths, or all of them. Without a base url
+    the stored copies are dropped instead. Returns the number written.
+    """
+    if paths is ALL:
+        paths = get_all_paths()
+    base_url = get_base_url()
+    last_modified = models.ComicPage.get_last_modified(None, forums=False)
+
+    written = 0
+    for path in paths:
+        if base_url is None:
+            remove(path)
+            continue
+        try:
+            body, content_type = render(path, base_url)
+        except Http404:
+            remove(path)
+            continue
+        write(path, body, content_type, last_modified)
+        written += 1
+    return written
+
+def get_alias_paths(alias):
+    """
+    Feeds that a save of alias can change, since pages carry their owner's
+    name: the main feeds, the alias's own, and those of the arcs of its pages
+    """
+    pages = models.ComicPage.get_latest_queryset().filter(owner__hk=alias.hk)
+    result = feed_paths(None) + feed_paths('author', alias.hk)
+    for arc_hk in sorted(set(pages.values_list('arc__hk', flat=True))):
+        result += feed_paths('arc', arc_hk)
+    return result
+
+def get_paths(instance):
+    """
+    Feeds that a save of instance, a page, arc or alias, can change
+    """
+    if isinstance(instance, models.ComicPage):
+        return get_page_paths(instance)
+    elif isinstance(instance, models.ComicArc):
+        return feed_paths('arc', instance.hk)
+    elif isinstance(instance, models.Alias):
+        return get_alias_paths(instance)
+    return []
+
+def regenerate_saved(model, pk):
+    regenerate(get_paths(model.objects.get(pk=pk)))
+
+def drop(instance):
+    for path in get_paths(instance):
+        remove(path)
+
+def schedule(instance):
+    """
+    Regenerate the feeds that a save of instance can change in the
+    background once the current transaction commits, or without workers,
+    drop them
+    """
+    if not is_enabled():
+        return
+
+    if not background.schedule('COMIC_STATIC_FEED_WORKERS',
+            regenerate_saved, type(instance), instance.pk):
+        transaction.on_commit(lambda: drop(instance))
@@ -0,0 +1,82 @@
+"""
+Storage for page image uploads that names each file by the sha256 of its
+contents.
+
+Every edit of a ComicPage is a new row, and an author re-uploading the same
+image would otherwise write another copy of it each time. Here an upload is
+streamed to a temporary file while it is hashed, then moved to
+<upload dir>/<first two hex digits>/<digest><extension>; if that file already
+exists the upload is dropped and the existing name returned. Since a name
+always refers to the same bytes, the files can be served with far-future,
+immutable cache headers.
+
+Files are shared between rows, and django leaves files behind when rows are
+deleted anyway; the dedupe_images management command moves older uploads
+into this layout and garbage collects files nothing refers to.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.core.files.move import file_move_safe
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_hashed_name(self, name, digest):
+        """
+        Where content with digest, uploaded as name, is stored
+        """
+        directory, filename = os.path.split(name)
+        ext = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest[:2], f'{digest}{ext}')
+
+    def hash_file(self, name):
+        """
+        sha256 of a stored file, read in chunks
+        """
+        digest = hashlib.sha256()
+        with self.open(name, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _save(self, name, content):
+        directory = os.path.dirname(self.path(name))
+        os.makedirs(directory, exist_ok=True)
+
+        digest = hashlib.sha256()
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    fp.write(chunk)
+
+            name = self.get_hashed_name(name, digest.hexdigest())
+            if self.exists(name):
+                #Identical content is already stored
+                os.remove(temp)
+                return name
+
+            full_path = self.path(name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            file_move_safe(temp, full_path, allow_overwrite=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(full_path, self.file_permissions_mode)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return name
+
+
+def get_image_storage():
+    return image_storage
+
+image_storage = ContentAddressedStorage()
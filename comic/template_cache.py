@@ -0,0 +1,59 @@
+"""
+A bounded LRU cache of compiled user templates.
+
+PageTemplate and PageTheme rows are never modified once written (an edit
+creates a new row), so the compiled django Template for a given row can be
+kept for as long as there is room for it. Entries are keyed by the version id
+of the row they came from; text that hasn't been saved yet, like a template
+being validated in an edit form, is keyed by a hash of its contents.
+
+The limits come from settings.COMIC_TEMPLATE_CACHE_ENTRIES (number of compiled
+templates) and settings.COMIC_TEMPLATE_CACHE_SIZE (total characters of
+template source).
+"""
+import hashlib
+
+from django.conf import settings
+from django.template import Template
+
+from .lru_cache import LRUCache
+
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_MAX_SIZE = 4 * 1024 * 1024
+
+
+class TemplateCache(LRUCache):
+
+    def compute(self, text):
+        return Template(text), len(text)
+
+    def get_template(self, key, text):
+        """
+        Return the compiled Template for text, compiling it only if there is
+        nothing cached under key.
+        """
+        return self.get(key, text)
+
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = TemplateCache(
+            getattr(settings, 'COMIC_TEMPLATE_CACHE_ENTRIES', DEFAULT_MAX_ENTRIES),
+            getattr(settings, 'COMIC_TEMPLATE_CACHE_SIZE', DEFAULT_MAX_SIZE))
+    return _cache
+
+def get_template(key, text):
+    return get_cache().get_template(key, text)
+
+def get_template_for_text(text):
+    """
+    Compile text that doesn't belong to a saved row yet
+    """
+    key = ('text', hashlib.sha256(text.encode()).hexdigest())
+    return get_cache().get_template(key, text)
+
+def stats():
+    return get_cache().stats()
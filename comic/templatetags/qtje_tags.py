@@ -1,13 +1,12 @@
 from django import template
 from django.utils.http import urlencode
-import markdown
 import urllib
 
+from comic import markdown_cache
+
 register = template.Library()
 
 @register.filter(name='render_markdown')
 def render_markdown(value):
     if value == None: return ''
-    md = markdown.Markdown(extensions=['extra', 'sane_lists', 'nl2br'])
-    return md.convert(value)
-
+    return markdown_cache.convert(value)
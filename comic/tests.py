@@ -1,3 +1,149 @@
-from django.test import TestCase
+import datetime
 
-# Create your tests here.
+import django.utils.timezone
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import models
+from . import releases
+
+
+class ComicTestCase(TestCase):
+    """
+    An author with an alias, template, theme and arc to make pages with
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('author')
+        author = models.Author.objects.create(user=self.user)
+        self.alias = models.Alias(owner=author, display_name='Author')
+        self.alias.save()
+        self.template = models.PageTemplate(owner=self.alias, name='Template', template='')
+        self.template.save()
+        self.theme = models.PageTheme(owner=self.alias, name='Theme')
+        self.theme.save()
+        self.arc = models.ComicArc(owner=self.alias, slug_name='arc', display_name='Arc')
+        self.arc.save()
+
+    def make_page(self):
+        page = models.ComicPage(owner=self.alias, page_key=models.ComicPage.get_next_page_key(),
+                    arc=self.arc, template=self.template, theme=self.theme)
+        page.save()
+        return page
+
+
+@override_settings(COMIC_LINKS_BY_PAGE_KEY=False)
+class PageLinkRepointTests(ComicTestCase):
+    """
+    Saving a new version of a page moves its live links over to the new
+    version with one UPDATE per direction, however many links there are
+    """
+
+    def make_links(self, page, other, count, deleted=0):
+        """
+        count live links each way between page and other, and deleted dead
+        ones each way
+        """
+        now = django.utils.timezone.now()
+        links = []
+        for i in range(count + deleted):
+            deleted_at = now if i >= count else None
+            links.append(models.ComicLink(kind='n', from_page=other, to_page=page,
+                            from_key=other.page_key, to_key=page.page_key,
+                            owner=self.alias, deleted_at=deleted_at))
+            links.append(models.ComicLink(kind='p', from_page=page, to_page=other,
+                            from_key=page.page_key, to_key=other.page_key,
+                            owner=self.alias, deleted_at=deleted_at))
+        models.ComicLink.objects.bulk_create(links)
+
+    def save_new_version(self, page):
+        page = models.ComicPage.objects.get(pk=page.pk)
+        page.title = 'Edited'
+        page.save()
+        return page
+
+    def test_links_follow_new_version(self):
+        page = self.make_page()
+        other = self.make_page()
+        self.make_links(page, other, 300, deleted=40)
+        old_pk = page.pk
+
+        #The same page with a handful of links sets the expected query count
+        small = self.make_page()
+        self.make_links(small, other, 2, deleted=1)
+        with CaptureQueriesContext(connection) as queries:
+            self.save_new_version(small)
+
+        with self.assertNumQueries(len(queries)):
+            new = self.save_new_version(page)
+        self.assertNotEqual(new.pk, old_pk)
+
+        live = models.ComicLink.objects.filter(deleted_at__isnull=True)
+        dead = models.ComicLink.objects.filter(deleted_at__isnull=False)
+        self.assertEqual(live.filter(to_page_id=new.pk).count(), 300)
+        self.assertEqual(live.filter(from_page_id=new.pk).count(), 300)
+        self.assertFalse(live.filter(to_page_id=old_pk).exists())
+        self.assertFalse(live.filter(from_page_id=old_pk).exists())
+        self.assertEqual(dead.filter(to_page_id=old_pk).count(), 40)
+        self.assertEqual(dead.filter(from_page_id=old_pk).count(), 40)
+        self.assertFalse(dead.filter(to_page_id=new.pk).exists())
+        self.assertFalse(dead.filter(from_page_id=new.pk).exists())
+
+    def test_scheduled_version_waits_for_release(self):
+        page = self.make_page()
+        other = self.make_page()
+        self.make_links(page, other, 2)
+        released_pk = page.pk
+
+        scheduled = models.ComicPage.objects.get(pk=page.pk)
+        scheduled.publish_at = django.utils.timezone.now() + datetime.timedelta(days=1)
+        scheduled.save()
+        self.assertNotEqual(scheduled.pk, released_pk)
+
+        #Readers still see the released version, with its links
+        live = models.ComicLink.objects.filter(deleted_at__isnull=True)
+        self.assertEqual(live.filter(to_page_id=released_pk).count(), 2)
+        self.assertEqual(live.filter(from_page_id=released_pk).count(), 2)
+        view = models.ComicPage.get_view_page(django.utils.timezone.now(), page.page_key)
+        self.assertEqual(view.pk, released_pk)
+        self.assertEqual(len(view.prev_links), 2)
+
+        releases.take_links(releases.get_due(scheduled.released_at - datetime.timedelta(seconds=1),
+                                scheduled.released_at))
+        self.assertEqual(live.filter(to_page_id=scheduled.pk).count(), 2)
+        self.assertEqual(live.filter(from_page_id=scheduled.pk).count(), 2)
+        view = models.ComicPage.get_view_page(scheduled.released_at, page.page_key)
+        self.assertEqual(view.pk, scheduled.pk)
+        self.assertEqual(len(view.prev_links), 2)
+
+
+class CanLinkTests(ComicTestCase):
+    """
+    Deleted links don't count against the limit on links from a page, in
+    either addressing mode
+    """
+
+    def check_deleted_links_free_up(self):
+        page = self.make_page()
+        other = self.make_page()
+        for _ in range(2):
+            link = models.ComicLink(kind='n', from_page=page, to_page=other, owner=self.alias)
+            link.save()
+            self.assertTrue(models.ComicPage.get_latest(page.page_key).can_link('n', self.user))
+            link.deleted_at = django.utils.timezone.now()
+            link.save()
+
+        page = models.ComicPage.get_latest(page.page_key)
+        page.title = 'Edited'
+        page.save()
+        self.assertTrue(models.ComicPage.get_latest(page.page_key).can_link('n', self.user))
+
+    @override_settings(COMIC_LINKS_BY_PAGE_KEY=False)
+    def test_by_page_version(self):
+        self.check_deleted_links_free_up()
+
+    @override_settings(COMIC_LINKS_BY_PAGE_KEY=True)
+    def test_by_page_key(self):
+        self.check_deleted_links_free_up()
@@ -11,7 +11,7 @@ app_name = 'comic'
 urlpatterns = [
     path('authors', views.AuthorsView.as_view(), name='authors'),
     path('forum', views.ForumView.as_view(), name='forum'),
-    path('archive', views.index, name='archive'),
+    path('archive', views.ArchiveView.as_view(), name='archive'),
     path('post', views.do_forum_post),
 
     path('about', TemplateView.as_view(template_name='comic/about.html'), name='about'),
@@ -20,6 +20,11 @@ urlpatterns = [
     path('logout', auth_views.LogoutView.as_view(next_page='comic:index'), name='logout'),
 
     path('rss', views.PageFeed(), name='rss'),
+    path('atom', views.AtomPageFeed(), name='atom'),
+    path('rss/arc/<int:hk>', views.ArcFeed(), name='rss_arc'),
+    path('atom/arc/<int:hk>', views.AtomArcFeed(), name='atom_arc'),
+    path('rss/author/<int:hk>', views.AuthorFeed(), name='rss_author'),
+    path('atom/author/<int:hk>', views.AtomAuthorFeed(), name='atom_author'),
 
     path('help/<str:pk>', views.HelpPageView.as_view(), name='help'),
 
@@ -40,6 +45,8 @@ urlpatterns = [
     path('edit/theme', views.ThemeCreateView.as_view(), name='edit_theme'),
 
 
+    path('search/<str:model>', views.SearchView.as_view(), name='search'),
+
     path('list/pages', views.PageEditListView.as_view(), name='list_pages'),
     path('list/links', views.LinkEditListView.as_view(), name='list_links'),
     path('list/templates', views.TemplateEditListView.as_view(), name='list_templates'),
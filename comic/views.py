@@ -1,11 +1,9 @@
 import os
-import mimetypes
+import hashlib
 import urllib.parse
 import datetime
 import dateutil.parser
 
-import markdown
-
 from django.shortcuts import render
 
 from django.http import HttpResponse, HttpResponseRedirect
@@ -14,6 +12,10 @@ import django.http
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 
 from django.views import generic
+from django.core.paginator import Paginator
+from django.db.models import Min, Max
+from django.views.decorators.http import condition
+from django.utils.decorators import method_decorator
 
 from django.template import Template, Context
 
@@ -22,7 +24,7 @@ from django.contrib.syndication.views import Feed
 
 from django.urls import reverse_lazy
 
-from django.utils.feedgenerator import Enclosure
+from django.utils.feedgenerator import Enclosure, Atom1Feed
 
 from django.conf import settings
 
@@ -30,6 +32,10 @@ from . import models
 from .models import ComicPage, ForumPost
 
 from . import forms
+from . import page_cache
+from . import link_graph
+from . import markdown_cache
+from . import static_feeds
 
 # Create your views here.
 
@@ -58,13 +64,116 @@ def get_date_from_request(request):
     date = request.GET.get('date', None)
     return process_date(date)        
 
+def get_past_date_from_request(request):
+    """
+    The date requested if it is in the past, otherwise None, for the
+    current version
+    """
+    date = request.GET.get('date', None)
+    if date is None:
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    date = process_date(date)
+    return date if date < now else None
+
+def get_date_querystring(request, separator='?'):
+    """
+    The requested date, normalized, as a querystring for links to carry
+    over, or '' when viewing the current version
+    """
+    date = get_past_date_from_request(request)
+    if date is None:
+        return ''
+    return separator + urllib.parse.urlencode({'date': date.isoformat()})
+
 def get_querystring_from_request(request):
     querystring = request.GET.urlencode()
     if querystring != '':
         querystring = '?' + querystring
     return querystring
 
-class ComicView(generic.DetailView):
+#
+# Conditional GET support
+#
+
+def get_last_modified_from_request(request, forums=True):
+    """
+    The last modification of anything visible at the date requested, looked
+    up once per request.
+    """
+    try:
+        return request._comic_last_modified
+    except AttributeError:
+        pass
+    date = get_date_from_request(request)
+    request._comic_last_modified = models.ComicPage.get_last_modified(date, forums)
+    return request._comic_last_modified
+
+def page_last_modified(request, *args, **kwargs):
+    #Logged in users see a different header, so they only get ETags
+    if request.user.is_authenticated:
+        return None
+    return get_last_modified_from_request(request)
+
+def page_etag(request, *args, **kwargs):
+    last_modified = get_last_modified_from_request(request)
+    if last_modified is None:
+        return None
+    value = f'{last_modified.isoformat()} {request.get_full_path()} {request.user.pk}'
+    return hashlib.sha256(value.encode()).hexdigest()
+
+def feed_last_modified(request, *args, **kwargs):
+    entry = static_feeds.get_entry(request)
+    if entry is not None:
+        return entry['last_modified']
+    return get_last_modified_from_request(request, forums=False)
+
+def feed_etag(request, *args, **kwargs):
+    last_modified = feed_last_modified(request)
+    if last_modified is None:
+        return None
+    value = f'{last_modified.isoformat()} {request.get_full_path()}'
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+class PageCacheMixin():
+    """
+    Answers conditional GETs, and serves anonymous GETs from the rendered
+    page cache. Views using this should put page_cache.CSRF_PLACEHOLDER in
+    the csrf_token context variable whenever self.cache_key is set, and
+    build their links from get_date_querystring.
+    """
+
+    #Query parameters other than date that the render depends on
+    cache_params = []
+
+    def get_cache_path(self, request):
+        path = request.path + get_date_querystring(request)
+        params = {k: request.GET[k] for k in self.cache_params if k in request.GET}
+        if len(params) > 0:
+            path = f'{path} {urllib.parse.urlencode(params)}'
+        return path
+
+    @method_decorator(condition(etag_func=page_etag, last_modified_func=page_last_modified))
+    def get(self, request, *args, **kwargs):
+        self.cache_key = None
+        if request.user.is_authenticated:
+            return super().get(request, *args, **kwargs)
+
+        historical = get_past_date_from_request(request) is not None
+
+        #Any save, or a scheduled release, moves the last modification, so
+        #current renders from before it are never found again
+        self.cache_key = page_cache.get_key(self.get_cache_path(request), historical,
+                                            get_last_modified_from_request(request))
+        response = page_cache.get_page(request, self.cache_key)
+        if response is not None:
+            return response
+
+        response = super().get(request, *args, **kwargs)
+        return page_cache.set_page(request, self.cache_key, response, historical)
+
+class ComicView(PageCacheMixin, generic.DetailView):
     model = ComicPage 
     template_name = 'comic/main.html'
 
@@ -89,7 +198,9 @@ class ComicView(generic.DetailView):
         if instance is None:
             raise django.http.Http404('No such page at this time.')
 
-        result['querystring'] = get_querystring_from_request(self.request)
+        result['querystring'] = get_date_querystring(self.request)
+        if self.cache_key is not None:
+            result['csrf_token'] = page_cache.CSRF_PLACEHOLDER
 
         result['body'] = instance.render_template(self.date, context=result)
         result['theme_values'] = instance.render_theme(self.date, context=result)
@@ -137,18 +248,34 @@ def do_forum_post(request):
 #
 
 class PageFeed(Feed):
+    """
+    The ten newest pages. Serves the copy written by static_feeds when there
+    is one from after the latest release, and renders live otherwise.
+    """
 
     title = 'qtjev2'
     link = '/'
     description = 'A webcomic of depression, sarcasm, irony, and ennui. Updates whenever.'
 
+    @method_decorator(condition(etag_func=feed_etag, last_modified_func=feed_last_modified))
+    def __call__(self, request, *args, **kwargs):
+        entry = static_feeds.get_entry(request)
+        if entry is not None:
+            return HttpResponse(entry['body'], content_type=entry['content_type'])
+        static_feeds.remember_base_url(request)
+        return super().__call__(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         result = super().get_context_data(**kwargs)
         self.request = kwargs['request']
         return result
 
-    def items(self):
-        return models.ComicPage.get_all_latest()[:10]
+    def get_items_queryset(self, obj):
+        return models.ComicPage.get_latest_queryset(date=process_date(None))
+
+    def items(self, obj):
+        items = list(self.get_items_queryset(obj).select_related('owner')[:10])
+        return models.ImageVariant.attach(items)
 
     def item_title(self, item):
         if item.title != '':
@@ -160,11 +287,59 @@ class PageFeed(Feed):
         return item.alt_text
 
     def item_enclosures(self, item):
-        image = item.image
-        mime = mimetypes.guess_type(image.url)[0]
+        image = item.get_image(getattr(settings, 'COMIC_FEED_IMAGE_VARIANT', None))
         url = self.request.build_absolute_uri(image.url)
-        entry = Enclosure(url = url, length = str(image.size), mime_type=mime)
+        entry = Enclosure(url = url, length = str(image.size), mime_type=image.mime_type)
         return [entry]
+
+class ArcFeed(PageFeed):
+    """
+    The ten newest pages in a story arc
+    """
+    link = '/archive'
+
+    def get_object(self, request, hk):
+        try:
+            return models.ComicArc.get_latest(hk)
+        except models.ComicArc.DoesNotExist:
+            raise django.http.Http404('No such arc')
+
+    def title(self, obj):
+        return f'{PageFeed.title}: {obj.display_name}'
+
+    def get_items_queryset(self, obj):
+        return super().get_items_queryset(obj).filter(arc__hk=obj.hk)
+
+class AuthorFeed(PageFeed):
+    """
+    The ten newest pages by an alias
+    """
+    link = '/authors'
+
+    def get_object(self, request, hk):
+        try:
+            return models.Alias.get_latest(hk)
+        except models.Alias.DoesNotExist:
+            raise django.http.Http404('No such author')
+
+    def title(self, obj):
+        return f'{PageFeed.title}: pages by {obj.display_name}'
+
+    def get_items_queryset(self, obj):
+        return super().get_items_queryset(obj).filter(owner__hk=obj.hk)
+
+class AtomPageFeed(PageFeed):
+    feed_type = Atom1Feed
+    subtitle = PageFeed.description
+
+class AtomArcFeed(ArcFeed):
+    feed_type = Atom1Feed
+    subtitle = PageFeed.description
+
+class AtomAuthorFeed(AuthorFeed):
+    feed_type = Atom1Feed
+    subtitle = PageFeed.description
+
 #
 # Additional pages for users
 #
@@ -172,40 +347,92 @@ class PageFeed(Feed):
 class AuthorsView(generic.ListView):
     model = models.Alias
 
+    def get_queryset(self):
+        self.date = process_date(None)#get_date_from_request(self.request)
+        return models.Alias.get_latest_queryset(date=self.date).order_by('hk')
+
     def get_context_data(self, **kwargs):
         result = super().get_context_data(**kwargs)
-        date = process_date(None)#get_date_from_request(self.request)
+        date = self.date
 
         result['querystring'] = ''#get_querystring_from_request(self.request)
 
+        #First and last current page of every alias in one grouped query
+        pages = models.ComicPage.get_latest_queryset(date=date)
+        ranges = pages.order_by().values('owner__hk').annotate(
+                    first=Min('page_key'), last=Max('page_key'))
+        ranges = {x['owner__hk']: x for x in ranges}
+
+        keys = {x['first'] for x in ranges.values()} | {x['last'] for x in ranges.values()}
+        pages = {x.page_key: x for x in pages.filter(page_key__in=keys)}
+
+        conflicts = models.Alias.get_conflict_index(date)
+
         object_list = {}
-        names_list = []
         for entry in result['object_list']:
-            entry = entry.as_of(date)
-            pages = models.ComicPage.objects.filter(owner__hk = entry.hk).order_by('-page_key')
             if not entry.display_name in object_list.keys():
-                saned = entry.sanitize(date)
-                author_entry = {
-                    'name': saned,
-                    }
-                if len(pages) > 0:
-                    author_entry['last'] = pages[0]
-                    author_entry['first'] = pages[len(pages)-1]
-                object_list[entry.display_name] = (author_entry)
-            else:
-                author_entry = object_list[entry.display_name]
-                if len(pages) > 0:
-                    if pages[0].page_key > author_entry['last'].page_key:
-                        author_entry['last'] = pages[0]
-                    if pages[len(pages)-1].page_key < author_entry['first'].page_key:
-                        author_entry['first'] = pages[len(pages)-1]
-                
+                object_list[entry.display_name] = {'name': entry.get_safe_names(conflicts)}
+            author_entry = object_list[entry.display_name]
+            page_range = ranges.get(entry.hk)
+            if page_range is None:
+                continue
+            first = pages[page_range['first']]
+            last = pages[page_range['last']]
+            if not 'last' in author_entry.keys() or last.page_key > author_entry['last'].page_key:
+                author_entry['last'] = last
+            if not 'first' in author_entry.keys() or first.page_key < author_entry['first'].page_key:
+                author_entry['first'] = first
 
         result['object_list'] = object_list.values()
 
         return result
         
 
+class ArchiveView(PageCacheMixin, generic.ListView):
+    template_name = 'comic/archive.html'
+    paginate_by = 200
+    cache_params = ['page']
+
+    def get_queryset(self):
+        self.date = get_date_from_request(self.request)
+        result = models.ComicPage.get_latest_queryset(date=self.date)
+        return result.select_related('owner', 'arc').order_by('page_key')
+
+    def get_context_data(self, **kwargs):
+        result = super().get_context_data(**kwargs)
+
+        if self.cache_key is not None:
+            result['csrf_token'] = page_cache.CSRF_PLACEHOLDER
+
+        #Page links only carry the date, not which archive page they're on
+        result['querystring'] = get_date_querystring(self.request)
+        result['date_querystring'] = get_date_querystring(self.request, '&')
+
+        pages = list(result['object_list'])
+        arcs = models.ComicArc.get_latest_queryset(date=self.date)
+        arcs = {x.hk: x for x in arcs.filter(hk__in={x.arc.hk for x in pages})}
+        authors = models.Alias.sanitize_batch([x.owner for x in pages], self.date)
+
+        groups = {}
+        for page, author in zip(pages, authors):
+            arc = arcs.get(page.arc.hk, page.arc)
+            if not arc.hk in groups.keys():
+                groups[arc.hk] = {'arc': arc, 'pages': []}
+            groups[arc.hk]['pages'].append({'page': page, 'author': author})
+
+        #The current archive lists each arc in reading order, with pages off
+        #the reading path after it. The graph only knows the current links.
+        if get_past_date_from_request(self.request) is None:
+            graph = link_graph.get_graph()
+            for arc_hk, group in groups.items():
+                order = {k: i for i, k in enumerate(graph.reading_path(arc_hk))}
+                group['pages'].sort(key = lambda x: (order.get(x['page'].page_key, len(order)),
+                                                     x['page'].page_key))
+
+        result['arcs'] = groups.values()
+
+        return result
+
 class ForumView(generic.ListView):
     model = models.ForumPost
     paginate_by = 100
@@ -219,18 +446,32 @@ class HelpPageView(LoginRequiredMixin, generic.TemplateView):
     login_url = '/login'
     template_name = 'comic/help_page.html'
 
+    #{filename: (mtime, compiled Template)}, so a help page file is only
+    #read and compiled again after it changes
+    help_templates = {}
+
+    @classmethod
+    def get_help_template(cls, filename):
+        mtime = os.stat(filename).st_mtime_ns
+        cached = cls.help_templates.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(filename, 'r') as fp:
+            data = fp.read()
+        data = '{% load static %}\n'+data
+        result = Template(data)
+        cls.help_templates[filename] = (mtime, result)
+        return result
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         pk = kwargs.get('pk', 'quickstart') 
         
         filename = os.path.join(settings.MEDIA_ROOT, f'help/{pk}.md')
         
-        md = markdown.Markdown(extensions=['extra', 'sane_lists', 'nl2br'])
-        with open(filename, 'r') as fp:
-            data = fp.read()
-        data = '{% load static %}\n'+data
-        data = Template(data).render(Context(context))
-        context['content'] = md.convert(data)
+        data = self.get_help_template(filename).render(Context(context))
+        context['content'] = markdown_cache.convert(data)
 
         return context
 
@@ -251,7 +492,7 @@ class PageEditView(LoginRequiredMixin, generic.edit.UpdateView):
 
         date = process_date(None)
         try:
-            result = models.ComicPage.get_view_page(date, page_key_str, sanitize = False)
+            result = models.ComicPage.get_view_page(date, page_key_str, sanitize = False, released = False)
         except ValueError:
             result = None
 
@@ -397,6 +638,49 @@ class ThemeCreateView(GenericCreateView):
 
 
 
+#
+# Autocomplete Search (For Authors)
+#
+
+class SearchView(LoginRequiredMixin, generic.View):
+    """
+    JSON prefix search over the current versions of a history model, used by
+    AutocompleteWidget. Takes q, the prefix to search for; page and limit for
+    paging through results; and mine, to only search the user's own entities.
+    """
+    login_url = '/login'
+
+    search_models = {
+        x.search_name: x for x in [
+            models.ComicPage, models.PageTemplate, models.PageTheme,
+            models.ComicArc, models.Alias,
+            ]
+        }
+    default_limit = 20
+    max_limit = 50
+
+    def get(self, request, *args, **kwargs):
+        model = self.search_models.get(kwargs['model'], None)
+        if model is None:
+            raise django.http.Http404('No such search')
+
+        try:
+            limit = int(request.GET.get('limit', self.default_limit))
+        except ValueError:
+            limit = self.default_limit
+        limit = max(1, min(limit, self.max_limit))
+
+        user = request.user if request.GET.get('mine', None) else None
+        results = model.search(request.GET.get('q', '').strip(), user)
+        page = Paginator(results, limit).get_page(request.GET.get('page', 1))
+
+        return django.http.JsonResponse({
+            'results': [{'key': key, 'label': label} for key, label in map(models.SearchEntry.choice, page)],
+            'page': page.number,
+            'has_next': page.has_next(),
+            })
+
+
 #
 # Entity List Views (For Authors)
 #
@@ -413,11 +697,55 @@ class EditListView(LoginRequiredMixin, generic.ListView):
     new_link_text = 'New Whatever'
     edit_link_text = 'Edit'
 
+    paginate_by = 50
+
+    #Related history entities to show as their current versions
+    current_fields = ['owner']
+    #Other related rows the table shows
+    related_fields = []
+    #Table headers that can be sorted on, and the fields they sort by
+    sort_columns = {'Last Modified': 'created_at'}
+
+    def get_ordering(self):
+        sort = self.request.GET.get('sort', None)
+        if sort is not None and sort.lstrip('-') in self.sort_columns.values():
+            return [sort, 'pk']
+        return None
+
     def get_queryset(self):
-        result = self.model.get_all_latest(self.request.user, self.hk)
-        date = process_date(None)
-        for entry in result:
-            entry.owner = entry.owner.as_of(date)
+        result = self.model.get_latest_queryset(self.request.user, self.hk)
+        result = result.select_related(*self.current_fields, *self.related_fields)
+        ordering = self.get_ordering()
+        if ordering is not None:
+            result = result.order_by(*ordering)
+        return result
+
+    def resolve_current(self, object_list):
+        """
+        Replace the entities named by current_fields with their current
+        versions, using one query per field rather than one per row.
+        """
+        for field in self.current_fields:
+            related = self.model._meta.get_field(field).related_model
+            hks = {getattr(x, field).hk for x in object_list}
+            current = related.get_latest_queryset().filter(hk__in=hks)
+            current = {x.hk: x for x in current}
+            for entry in object_list:
+                setattr(entry, field, current[getattr(entry, field).hk])
+        return object_list
+
+    def get_sort_headers(self, header):
+        """
+        Pair each header with the sort parameter its link should use, which
+        reverses the order if the table is already sorted by that column.
+        """
+        current = self.request.GET.get('sort', None)
+        result = []
+        for name in header:
+            sort = self.sort_columns.get(name, None)
+            if sort is not None and sort == current:
+                sort = '-' + sort
+            result.append({'name': name, 'sort': sort})
         return result
 
     def get_context_data(self, **kwargs):
@@ -425,7 +753,11 @@ class EditListView(LoginRequiredMixin, generic.ListView):
 
         self.date = process_date(None)
 
-        result['table_map'] = self.render_table_map(result['object_list'])
+        object_list = self.resolve_current(list(result['object_list']))
+        result['table_map'] = self.render_table_map(object_list)
+        result['table_map']['header'] = self.get_sort_headers(result['table_map']['header'])
+        sort = self.request.GET.get('sort', None)
+        result['sort_querystring'] = '' if sort is None else '&' + urllib.parse.urlencode({'sort': sort})
         result['edit_url'] = self.edit_url
         result['new_url'] = self.new_url
         result['view_url'] = self.view_url
@@ -443,6 +775,9 @@ class PageEditListView(EditListView):
     new_url = 'comic:create_page'
     new_link_text = 'New Page'
 
+    current_fields = ['owner', 'arc']
+    sort_columns = {'Page Number': 'page_key', 'Title': 'title', 'Last Modified': 'created_at'}
+
     def render_table_map(self, object_list):
         header = ['Page Number', 'Title', 'Story Arc', 'Alt Text', 'Owner', 'Last Modified']
         tables = []
@@ -469,6 +804,14 @@ class LinkEditListView(EditListView):
     edit_link_text = 'Delete'
     template_name = 'comic/link_list.html'
 
+    related_fields = ['from_page', 'to_page']
+    sort_columns = {
+        'Link type': 'kind',
+        'From Page': 'from_page__page_key',
+        'To Page': 'to_page__page_key',
+        'Creation Date': 'created_at',
+        }
+
     def render_table_map(self, object_list):
         header = ['Link type', 'From Page', 'To Page', 'Owner', 'Creation Date']
         tables = []
@@ -499,6 +842,8 @@ class TemplateEditListView(EditListView):
     new_url = 'comic:edit_template'
     new_link_text = 'New Template'
 
+    sort_columns = {'Key': 'hk', 'Name': 'name', 'Last Modified': 'created_at'}
+
     def render_table_map(self, object_list):
         header = ['Key', 'Name', 'Owner', 'Last Modified']
         tables = []
@@ -523,6 +868,8 @@ class ThemeEditListView(EditListView):
     new_url = 'comic:edit_theme'
     new_link_text = 'New Theme'
 
+    sort_columns = {'Key': 'hk', 'Name': 'name', 'Last Modified': 'created_at'}
+
     def render_table_map(self, object_list):
         header = ['Key', 'Name', 'Owner', 'Last Modified']
         tables = []
@@ -547,6 +894,10 @@ class AliasEditListView(EditListView):
     new_url = 'comic:edit_alias'
     new_link_text = 'New Alias'
 
+    #Alias owners are Authors, which have no history
+    current_fields = []
+    sort_columns = {'Key': 'hk', 'Name': 'display_name', 'Last Modified': 'created_at'}
+
     def render_table_map(self, object_list):
         header = ['Key', 'Name', 'Last Modified']
         tables = []
@@ -571,6 +922,8 @@ class ArcEditListView(EditListView):
     new_url = 'comic:edit_arc'
     new_link_text = 'New Story Arc'
 
+    sort_columns = {'Key': 'hk', 'Slug': 'slug_name', 'Name': 'display_name', 'Last Modified': 'created_at'}
+
     def render_table_map(self, object_list):
         header = ['Key', 'Slug', 'Name', 'Last Modified']
         tables = []
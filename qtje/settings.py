@@ -43,6 +43,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'comic.middleware.IdentityMapMiddleware',
 ]
 
 ROOT_URLCONF = 'qtje.urls'
@@ -117,3 +118,100 @@ MEDIA_URL = '/media/'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Logging
+# https://docs.djangoproject.com/en/3.2/topics/logging/
+
+# The comic app logs diagnostics at DEBUG. Messages are formatted lazily, so
+# they cost nothing unless COMIC_LOG_LEVEL=DEBUG is set in the environment.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'comic': {
+            'format': '{asctime} {levelname} {name} {process:d} {message}',
+            'style': '{',
+        },
+    },
+    'handlers': {
+        'comic_console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'comic',
+        },
+    },
+    'loggers': {
+        'comic': {
+            'handlers': ['comic_console'],
+            'level': os.environ.get('COMIC_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+
+# Comic app settings
+
+# Serve latest-version lookups from the CurrentVersion pointer table.
+# Run manage.py rebuild_current_versions before turning this on.
+COMIC_CURRENT_VERSIONS = False
+
+# Limits for the compiled user template cache: how many templates to keep,
+# and the total number of characters of template source they may hold.
+COMIC_TEMPLATE_CACHE_ENTRIES = 512
+COMIC_TEMPLATE_CACHE_SIZE = 4 * 1024 * 1024
+
+# Cache used for rendered reader pages, and how long renders of the current
+# version of a page and of past dates are kept.
+COMIC_PAGE_CACHE = 'default'
+COMIC_PAGE_CACHE_TIMEOUT = 3600
+COMIC_PAGE_CACHE_PAST_TIMEOUT = 7*24*3600
+
+# Address links by stable page key rather than by page version, so editing a
+# page doesn't rewrite its links. Run manage.py backfill_link_keys first.
+COMIC_LINKS_BY_PAGE_KEY = False
+
+# Fill author form autocomplete lists from the search endpoint as the author
+# types, rather than listing every page, template, theme, arc and alias.
+COMIC_AUTOCOMPLETE_REMOTE = True
+
+# Limits for the converted Markdown cache used for transcripts and help pages:
+# how many texts to keep, and the total number of characters of HTML.
+COMIC_MARKDOWN_CACHE_ENTRIES = 1024
+COMIC_MARKDOWN_CACHE_SIZE = 8 * 1024 * 1024
+
+# Derivatives made of every uploaded page image: a maximum width (None keeps
+# the original's) and a Pillow format for each. Formats Pillow wasn't built
+# with are skipped.
+COMIC_IMAGE_VARIANTS = {
+    'webp-full': {'width': None, 'format': 'WEBP'},
+    'webp-800': {'width': 800, 'format': 'WEBP'},
+    'avif-full': {'width': None, 'format': 'AVIF'},
+    'avif-800': {'width': 800, 'format': 'AVIF'},
+}
+COMIC_IMAGE_VARIANT_QUALITY = 80
+
+# Background threads per process that generate variants after an upload.
+# With 0, run manage.py generate_image_variants to make them instead.
+COMIC_IMAGE_VARIANT_WORKERS = 1
+
+# Variants offered to browsers ahead of the original on the default page
+# layout, best format first. Variants of one format are offered together,
+# as a srcset for the browser to pick a width from, so each format should
+# have one at full width. Also the variant used for RSS enclosures (None for
+# the original upload).
+COMIC_PAGE_IMAGE_SOURCES = ['avif-full', 'avif-800', 'webp-full', 'webp-800']
+COMIC_FEED_IMAGE_VARIANT = 'webp-full'
+
+# Write the RSS and Atom feeds to files whenever a page, arc or alias is
+# saved, and serve those instead of rendering feeds on every poll. Feeds have
+# absolute urls, so they are rendered against COMIC_FEED_BASE_URL (e.g.
+# 'https://example.com'), or the host of the last live feed request when it
+# is None. COMIC_FEED_ROOT defaults to feeds/ under MEDIA_ROOT.
+COMIC_STATIC_FEEDS = True
+COMIC_FEED_BASE_URL = None
+COMIC_FEED_ROOT = None
+
+# Background threads per process that render the feeds after a save. With 0,
+# a save only drops the affected copies; run manage.py generate_feeds to
+# write them again.
+COMIC_STATIC_FEED_WORKERS = 1